@@ -1,24 +1,153 @@
+import ast
 import sys
 import shlex
 from math import sqrt
 
+from pandas import read_csv
+
 from Common import *
 from Particles import *
 from Fields import *
 
+class LazyTrackedData:
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self.rows = self.index['rows']
+        self.tables = self.index.get('tables', {})
+        self.maps = {}
+        self.extra = {}
+        self.sources = {}
+        for c in self.index['columns']:
+            if c['width'] == 3:
+                for k, axis in enumerate(('x', 'y', 'z')):
+                    self.sources.update({(c['name'] + ' - ' + axis): (c['file'], 3, k)})
+            else:
+                self.sources.update({c['name']: (c['file'], c['width'] or 1, 0)})
+
+    def getMap(self, file: str, width: int) -> np.ndarray:
+        if file not in self.maps:
+            if self.rows == 0:
+                self.maps.update({file: np.zeros((0, width), float)})
+            else:
+                self.maps.update({file: np.memmap(os.path.join(self.path, file), float, 'r',
+                                                  shape = (self.rows, width))})
+        return self.maps[file]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name in self.extra:
+            return self.extra[name]
+        file, width, k = self.sources[name]
+        return self.getMap(file, width)[:, k]
+
+    def getTable(self, name: str) -> DataFrame:
+        # Tables are written out when the log is saved, so a run still in progress may not have them yet
+        if name not in self.tables:
+            return DataFrame()
+        file = os.path.join(self.path, self.tables[name])
+        if not os.path.exists(file) or os.path.getsize(file) == 0:
+            return DataFrame()
+        return read_csv(file)
+
+    def getTableNames(self) -> List[str]:
+        return list(self.tables)
+
+    def __setitem__(self, name: str, values):
+        self.extra.update({name: np.asarray(values)})
+
+    def __iter__(self):
+        return iter(list(self.sources) + list(self.extra))
+
+    def __len__(self):
+        return self.rows
+
+    def toDataFrame(self, cols: List[str] = None) -> DataFrame:
+        if cols is None:
+            cols = list(self)
+        return DataFrame({i: self[i] for i in cols})
+
+    def __str__(self):
+        return str(self.toDataFrame())
+
+
+class ColumnExpression:
+    FUNCTIONS = {'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10, 'abs': np.abs,
+                 'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'arcsin': np.arcsin, 'arccos': np.arccos,
+                 'arctan': np.arctan, 'arctan2': np.arctan2, 'hypot': np.hypot,
+                 'minimum': np.minimum, 'maximum': np.maximum, 'where': np.where,
+                 'norm': lambda *c: np.sqrt(sum(np.square(x) for x in c)),
+                 'diff': lambda x: np.diff(x, prepend = x[:1]),
+                 'cumsum': np.cumsum, 'gradient': np.gradient,
+                 'unwrap': np.unwrap}
+    CONSTANTS = {'pi': np.pi, 'e': np.e}
+    CUMULATIVE = {'diff', 'cumsum', 'gradient', 'unwrap'}
+    NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Constant, ast.Load,
+             ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.USub, ast.UAdd,
+             ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+    def __init__(self, expression: str, columns: dict):
+        tree = ast.parse(expression, mode = 'eval')
+        self.names = set()
+        self.chunkable = True
+        for node in ast.walk(tree):
+            if not isinstance(node, self.NODES):
+                raise ValueError('Unsupported syntax: ' + type(node).__name__)
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in self.FUNCTIONS:
+                    raise ValueError('Unknown function: ' + ast.unparse(node.func))
+                if node.func.id in self.CUMULATIVE:
+                    self.chunkable = False
+            elif isinstance(node, ast.Name) and node.id not in self.FUNCTIONS:
+                if node.id in columns:
+                    self.names.add(node.id)
+                elif node.id not in self.CONSTANTS:
+                    raise ValueError('Unknown column: ' + node.id)
+            elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError('Unsupported constant: ' + repr(node.value))
+        self.columns = columns
+        self.code = compile(tree, '<newcol>', 'eval')
+
+    def evaluate(self, data, chunkSize: int = None) -> np.ndarray:
+        n = len(data)
+        if chunkSize is None or not self.chunkable or n <= chunkSize:
+            return self.evaluateRange(data, 0, n)
+        out = np.empty(n, float)
+        for i in range(0, n, chunkSize):
+            j = min(i + chunkSize, n)
+            out[i:j] = self.evaluateRange(data, i, j)
+        return out
+
+    def evaluateRange(self, data, i: int, j: int) -> np.ndarray:
+        env = dict(self.FUNCTIONS)
+        env.update(self.CONSTANTS)
+        for k in self.names:
+            env.update({k: np.asarray(data[self.columns[k]][i:j], float)})
+        return np.broadcast_to(eval(self.code, {'__builtins__': {}}, env), (j - i,))
+
+
 class AnalysisHandler:
+    CHUNK = 1 << 20
 
     @classmethod
-    def load(cls, inputFile: str) -> (DataFrame, DataFrame, DataFrame):
+    def load(cls, inputFile: str) -> (DataFrame, DataFrame, DataFrame, dict):
+        if os.path.isdir(inputFile):
+            tracked = LazyTrackedData(inputFile)
+            tables = {t: tracked.getTable(t) for t in tracked.getTableNames()}
+            return tracked.index['miscdata'], tracked.index['envdata'], tracked, tables
         with open(inputFile, 'rb') as f:
             data: SimLog = pickle.load(f)
         misc = data.getMiscData()
         env = data.getEnvData()
         tracked = data.getTrackedData()
-        return misc, env, tracked
+        tables = {t: data.getTable(t) for t in data.getTableNames()}
+        return misc, env, tracked, tables
 
     @classmethod
     def dump(cls, df: DataFrame, fType: str, name: str) -> str:
+        if isinstance(df, LazyTrackedData):
+            df = df.toDataFrame()
         if fType == 'csv':
             fname = name + '.csv'
             df.to_csv(fname)
@@ -31,8 +160,11 @@ class AnalysisHandler:
         return fname
 
     def __init__(self, inputFile: str):
-        self.name = inputFile.split('.')[0]
-        self.misc, self.env, self.tracked = self.load(inputFile)
+        self.name = inputFile.rstrip('/').split('.')[0]
+        self.misc, self.env, self.tracked, self.tables = self.load(inputFile)
+
+    def getTable(self, name: str) -> DataFrame:
+        return self.tables.get(name, DataFrame())
 
     def plot(self, x, y):
         plt.plot(self.tracked[x], self.tracked[y])
@@ -47,9 +179,15 @@ class AnalysisHandler:
         out = self.dump(DataFrame(dic), fType, self.name + '_trim')
         return out
 
-    def newcol(self, name: str, func):
+    def newcol(self, name: str, func, columns: dict = None):
         lis = []
-        if isinstance(func, str):
+        if isinstance(func, str) and columns is not None:
+            expr = ColumnExpression(func, columns)
+            if isinstance(self.tracked, LazyTrackedData):
+                lis = expr.evaluate(self.tracked, self.CHUNK)
+            else:
+                lis = expr.evaluate(self.tracked)
+        elif isinstance(func, str):
             for i in range(len(self.tracked)):
                 lis.append(eval(func))
         else:
@@ -62,10 +200,10 @@ class AnalysisShell:
     def __init__(self, inputFile: str):
         self.an = None
         self.inputFile = inputFile
-        self.name = inputFile.split('.')[0]
+        self.name = inputFile.rstrip('/').split('.')[0]
         self.coms = {'exit': self.ex, 'plot': self.plot, 'dump': self.dump,
                      'printcols': self.printcols, 'dumpcols': self.dumpcols,
-                     'newcol': self.newcol, 'help': self.hlp}
+                     'newcol': self.newcol, 'printtable': self.printtable, 'help': self.hlp}
 
     def plot(self, args):
         try:
@@ -84,6 +222,8 @@ class AnalysisShell:
             df = self.an.env
         elif args[1] == 'tracked':
             df = self.an.tracked
+        elif args[1] in self.an.tables:
+            df = self.an.getTable(args[1])
         else:
             log('Invalid data selection.')
             return
@@ -109,6 +249,14 @@ class AnalysisShell:
                     log('Invalid column: ' + i)
             log(DataFrame(dic))
 
+    def printtable(self, args):
+        if len(args) == 1:
+            print(list(self.an.tables))
+        elif args[1] in self.an.tables:
+            log(str(self.an.getTable(args[1])))
+        else:
+            log('Invalid table: ' + args[1])
+
     def dumpcols(self, args):
         if args[1] == 'all':
             try:
@@ -142,19 +290,24 @@ class AnalysisShell:
             dic.update({'a' + str(j): i})
             j += 1
         log('Column coefficients: ' + str(dic))
+        log('Functions: ' + ', '.join(ColumnExpression.FUNCTIONS))
         func = input('    f: ')
-        for k, v in dic.items():
-            func = func.replace(k, "self.tracked['" + v + "'][i]")
-        self.an.newcol(args[1], func)
+        try:
+            self.an.newcol(args[1], func, dic)
+        except (SyntaxError, ValueError) as e:
+            log('Invalid expression: ' + str(e))
+            return
         log('Succesfully added ' + args[1])
 
     def hlp(self, args):
         log('plot <x> <y>                          - Plot given colums as x and y')
         log('printcols <columns>                   - Print given columns to screen')
         log('dump <misc/env/tracked> <csv/pickle>  - Dump misc, environment or tracked data to csv or DataFrame pickle')
+        log('dump <table> <csv/pickle>             - Dump a sink or event table to csv or DataFrame pickle')
+        log('printtable <table>                    - Print a sink or event table to screen, or list the tables')
         log('dumpcols <columns> <csv/pickle>       - Dump given columns to csv or DataFrame pickle')
-        log(
-            'newcol <column_name>                  - Create new column, then populate with function of other column data')
+        log('newcol <column_name>                  - Create new column, then populate with function of other '
+            'column data')
         log('exit                                  - Quit program')
 
     def start(self):
@@ -175,6 +328,11 @@ class AnalysisShell:
         log('== Tracked ==')
         log(list(self.an.tracked))
         log()
+        if self.an.tables:
+            log('== Tables ==')
+            for k, v in self.an.tables.items():
+                log(str(k) + ' : ' + str(len(v)) + ' rows')
+            log()
 
         while True:
             inp = input('> ')
@@ -1,9 +1,11 @@
+import json
+import os
 import pickle
 from abc import ABC, abstractmethod
 from datetime import datetime
 from enum import Enum
 from pathlib import Path
-from typing import List, Type
+from typing import List, Tuple, Type
 
 import numpy as np
 import scipy.constants as const
@@ -22,6 +24,20 @@ class Approximation(Enum):
     EULER = 'Euler'
     EULER_CROMER = 'Euler-Cromer'
     VERLET = 'Verlet'
+    BORIS = 'Boris'
+    EXACT_ROTATION = 'Exact Rotation'
+    RK45 = 'Adaptive RK45'
+
+    def isElectromagnetic(self):
+        return self in (Approximation.BORIS, Approximation.EXACT_ROTATION, Approximation.RK45)
+
+    def isAdaptive(self):
+        return self is Approximation.RK45
+
+
+class Engine(Enum):
+    OBJECT = 'Object'
+    ARRAY = 'Array'
 
 
 class Axis(Enum):
@@ -36,12 +52,30 @@ class Region(ABC):
     def contains(self, point: np.array) -> bool:
         pass
 
+    def containsMany(self, points: np.ndarray) -> np.ndarray:
+        return np.array([self.contains(p) for p in points], bool)
+
+    def getBounds(self) -> Tuple[np.ndarray, np.ndarray]:
+        return np.full(3, -np.inf), np.full(3, np.inf)
+
+    def __or__(self, other: 'Region') -> 'Region':
+        return UnionRegion(self, other)
+
+    def __and__(self, other: 'Region') -> 'Region':
+        return IntersectionRegion(self, other)
+
+    def __invert__(self) -> 'Region':
+        return ComplementRegion(self)
+
 
 class AllRegion(Region):
 
     def contains(self, point: np.array):
         return True
 
+    def containsMany(self, points: np.ndarray):
+        return np.ones(len(points), bool)
+
 
 ALL_SPACE: Region = AllRegion()
 
@@ -78,6 +112,14 @@ class CubeRegion(Region):
         else:
             return False
 
+    def containsMany(self, points: np.ndarray):
+        lower = np.array([self.x1, self.y1, self.z1], float)
+        upper = np.array([self.x2, self.y2, self.z2], float)
+        return np.all((points >= lower) & (points <= upper), axis = 1)
+
+    def getBounds(self):
+        return np.array([self.x1, self.y1, self.z1], float), np.array([self.x2, self.y2, self.z2], float)
+
 
 class AxisRegion(Region):
 
@@ -96,6 +138,146 @@ class AxisRegion(Region):
         else:
             return False
 
+    def containsMany(self, points: np.ndarray):
+        x = points[:, self.axis.value]
+        return (x >= self.b1) & (x <= self.b2)
+
+    def getBounds(self):
+        lower, upper = super(AxisRegion, self).getBounds()
+        lower[self.axis.value] = self.b1
+        upper[self.axis.value] = self.b2
+        return lower, upper
+
+
+class CylinderRegion(Region):
+
+    def __init__(self, radius: float, axis: Axis = Axis.Z):
+        self.radius = radius
+        self.axis: Axis = axis
+
+    def contains(self, point: np.array):
+        return bool(self.containsMany(np.array([point], float))[0])
+
+    def containsMany(self, points: np.ndarray):
+        perp = np.delete(points, self.axis.value, axis = 1)
+        return np.einsum('ij,ij->i', perp, perp) <= self.radius ** 2
+
+    def getBounds(self):
+        lower = np.full(3, -float(self.radius))
+        upper = np.full(3, float(self.radius))
+        lower[self.axis.value] = -np.inf
+        upper[self.axis.value] = np.inf
+        return lower, upper
+
+
+class UnionRegion(Region):
+
+    def __init__(self, *regions: Region):
+        self.regions = regions
+
+    def contains(self, point: np.array):
+        return any(r.contains(point) for r in self.regions)
+
+    def containsMany(self, points: np.ndarray):
+        mask = np.zeros(len(points), bool)
+        for r in self.regions:
+            mask |= r.containsMany(points)
+        return mask
+
+    def getBounds(self):
+        bounds = [r.getBounds() for r in self.regions]
+        return np.min([b[0] for b in bounds], axis = 0), np.max([b[1] for b in bounds], axis = 0)
+
+
+class IntersectionRegion(Region):
+
+    def __init__(self, *regions: Region):
+        self.regions = regions
+
+    def contains(self, point: np.array):
+        return all(r.contains(point) for r in self.regions)
+
+    def containsMany(self, points: np.ndarray):
+        mask = np.ones(len(points), bool)
+        for r in self.regions:
+            mask &= r.containsMany(points)
+        return mask
+
+    def getBounds(self):
+        bounds = [r.getBounds() for r in self.regions]
+        return np.max([b[0] for b in bounds], axis = 0), np.min([b[1] for b in bounds], axis = 0)
+
+
+class ComplementRegion(Region):
+
+    def __init__(self, region: Region):
+        self.region = region
+
+    def contains(self, point: np.array):
+        return not self.region.contains(point)
+
+    def containsMany(self, points: np.ndarray):
+        return ~self.region.containsMany(points)
+
+
+class RegionIndex:
+
+    def __init__(self, regions: List[Region], cells: int = 16):
+        # Uniform grid over the finite extent of all region bounds; each region keeps the runs of cells it overlaps
+        bounds = [r.getBounds() for r in regions]
+        lower = np.array([b[0] for b in bounds], float).reshape(-1, 3)
+        upper = np.array([b[1] for b in bounds], float).reshape(-1, 3)
+        edges = np.concatenate((lower, upper))
+        self.origin = np.zeros(3, float)
+        self.cellSize = np.ones(3, float)
+        self.shape = np.ones(3, int)
+        for k in range(3):
+            finite = edges[:, k][np.isfinite(edges[:, k])]
+            if len(finite) and finite.max() > finite.min():
+                self.origin[k] = finite.min()
+                self.cellSize[k] = (finite.max() - finite.min()) / cells
+                self.shape[k] = cells
+        self.nCells = int(np.prod(self.shape))
+        self.runs: List[List[tuple]] = []
+        self.cellRegions: List[List[int]] = [[] for c in range(self.nCells)]
+        for j in range(len(regions)):
+            lo = self.getCoords(lower[j:j + 1])[0]
+            hi = self.getCoords(upper[j:j + 1])[0]
+            if np.any(lower[j] > upper[j]):
+                ids = np.zeros(0, int)
+            else:
+                grid = np.meshgrid(*[np.arange(lo[k], hi[k] + 1) for k in range(3)], indexing = 'ij')
+                ids = np.ravel_multi_index([g.ravel() for g in grid], self.shape)
+            breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+            self.runs.append([(int(run[0]), int(run[-1]) + 1) for run in np.split(ids, breaks) if len(run)])
+            for c in ids:
+                self.cellRegions[c].append(j)
+
+    def getCoords(self, points: np.ndarray) -> np.ndarray:
+        coords = np.floor((points - self.origin) / self.cellSize)
+        return np.clip(np.nan_to_num(coords, posinf = self.nCells, neginf = -1), 0, self.shape - 1).astype(int)
+
+    def getCells(self, points: np.ndarray) -> np.ndarray:
+        return np.ravel_multi_index(self.getCoords(points).T, self.shape)
+
+    def getCandidates(self, point: np.array) -> List[int]:
+        return self.cellRegions[self.getCells(np.array([point], float))[0]]
+
+    def query(self, points: np.ndarray) -> List[tuple]:
+        # Pairs of region index and the points that may fall inside it, None where a region spans every cell
+        cells = self.getCells(points)
+        order = np.argsort(cells, kind = 'stable')
+        starts = np.searchsorted(cells[order], np.arange(self.nCells + 1))
+        out = []
+        for j, runs in enumerate(self.runs):
+            if runs == [(0, self.nCells)]:
+                out.append((j, None))
+                continue
+            idx = np.concatenate([order[starts[a]:starts[b]] for a, b in runs] + [np.zeros(0, int)])
+            if len(idx):
+                out.append((j, idx))
+        return out
+
 
 class TrackableProperty(Enum):
 
@@ -120,6 +302,9 @@ class Trackable(ABC):
     def getTypeName(self) -> str:
         pass
 
+    def getPropertyLabels(self, p: TrackableProperty) -> List[str]:
+        return None
+
 class TrackableObject(Trackable, ABC):
 
     @abstractmethod
@@ -180,6 +365,7 @@ class SimLog:
         self.logging = False
         self.tracked: List[Trackable] = []
         self.rows: List[dict] = []
+        self.tables: dict = {}
         self.miscdata = {}
         self.envdata = {}
 
@@ -191,18 +377,38 @@ class SimLog:
     def track(self, t: Trackable, *trackedProperties: TrackableProperty):
         self.tracked.append((t, trackedProperties))
         for i in trackedProperties:
-            self.columns.append(t.getFullName() + ': ' + str(i))
+            labels = t.getPropertyLabels(i)
+            if labels is None:
+                self.columns.append(t.getFullName() + ': ' + str(i))
+            else:
+                self.columns.extend(t.getFullName() + ': ' + str(i) + ' - ' + l for l in labels)
+
+    def getValues(self) -> List[tuple]:
+        # Labelled properties are split into one scalar column per label
+        values = []
+        for t, props in self.tracked:
+            for i in props:
+                v = t.getProperty(i)
+                labels = t.getPropertyLabels(i)
+                if labels is None:
+                    values.append((t.getFullName() + ': ' + str(i), v))
+                else:
+                    values.extend((t.getFullName() + ': ' + str(i) + ' - ' + l, x) for l, x in zip(labels, v))
+        return values
 
     def log(self):
         dic = {}
-        for t in self.tracked:
-            for i in t[1]:
-                dic.update({(t[0].getFullName() + ': ' + str(i)): t[0].getProperty(i)})
+        for c, v in self.getValues():
+            if isinstance(v, np.ndarray):
+                v = np.copy(v)
+            dic.update({c: v})
         # self.out.writerow(dic)
         # self.file.flush()
         self.rows.append(dic)
 
     def getTrackedData(self) -> DataFrame:
+        if not self.rows:
+            return DataFrame(columns = self.columns)
         df: DataFrame = self.getRawTrackedData()
         vec = False
         for k, v in self.rows[0].items():
@@ -222,7 +428,27 @@ class SimLog:
             return DataFrame(dic)
 
     def getRawTrackedData(self) -> DataFrame:
-        return DataFrame(self.rows)
+        return DataFrame(self.rows, columns = self.columns)
+
+    def appendTable(self, name: str, columns: dict):
+        self.tables.setdefault(name, []).append(columns)
+
+    def getTable(self, name: str) -> DataFrame:
+        chunks = self.tables.get(name, [])
+        if not chunks:
+            return DataFrame()
+        return DataFrame({k: np.concatenate([c[k] for c in chunks]) for k in chunks[0]})
+
+    def getTableNames(self) -> List[str]:
+        return list(self.tables)
+
+    def getState(self) -> dict:
+        return {'rows': self.rows, 'tables': self.tables}
+
+    def setState(self, state: dict):
+        self.rows = list(state['rows'])
+        self.tables = dict(state['tables'])
+        self.logging = True
 
     def appendMiscData(self, data: dict):
         self.miscdata.update(data)
@@ -259,6 +485,121 @@ class SimLog:
         self.log()
 
 
+class StreamingSimLog(SimLog):
+
+    def __init__(self, name: str, chunkSize: int = 1024, path: str = None):
+        super(StreamingSimLog, self).__init__(name)
+        self.chunkSize = chunkSize
+        if path is None:
+            self.path = name + '_' + START_TIME_STR
+        else:
+            self.path = path
+        self.buffers: List[np.ndarray] = []
+        self.files: List[str] = []
+        self.nBuffered = 0
+        self.nRows = 0
+
+    def start(self):
+        super(StreamingSimLog, self).start()
+        Path(self.path).mkdir(parents = True, exist_ok = True)
+        self.files = ['col' + str(j) + '.bin' for j in range(len(self.columns))]
+        for f in self.files:
+            open(os.path.join(self.path, f), 'wb').close()
+        self.writeIndex()
+
+    def log(self):
+        values = [v for c, v in self.getValues()]
+        if not self.buffers:
+            for v in values:
+                self.buffers.append(np.full((self.chunkSize, np.size(v)), np.nan, float))
+        for b, v in zip(self.buffers, values):
+            b[self.nBuffered] = np.nan if v is None else v
+        self.nBuffered += 1
+        if self.nBuffered == self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.nBuffered == 0:
+            return
+        for b, f in zip(self.buffers, self.files):
+            with open(os.path.join(self.path, f), 'ab') as out:
+                b[:self.nBuffered].tofile(out)
+        self.nRows += self.nBuffered
+        self.nBuffered = 0
+        self.writeIndex()
+
+    def writeIndex(self):
+        index = {'name': self.name, 'rows': self.nRows, 'chunkSize': self.chunkSize,
+                 'columns': [{'name': c, 'file': f, 'width': (b.shape[1] if self.buffers else None)}
+                             for c, f, b in zip(self.columns, self.files, self.buffers or [None] * len(self.files))],
+                 'tables': {t: 'table' + str(j) + '.csv' for j, t in enumerate(self.tables)},
+                 'miscdata': self.miscdata, 'envdata': self.envdata}
+        tmp = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(index, f, default = str)
+        os.replace(tmp, os.path.join(self.path, 'index.json'))
+
+    def getState(self) -> dict:
+        self.flush()
+        return {'path': os.path.abspath(self.path), 'rows': self.nRows, 'widths': [b.shape[1] for b in self.buffers],
+                'tables': self.tables}
+
+    def setState(self, state: dict):
+        # Resume in the directory the checkpointed rows were written to, cutting off anything logged after them
+        self.logging = True
+        self.path = state['path']
+        self.files = ['col' + str(j) + '.bin' for j in range(len(self.columns))]
+        self.buffers = [np.full((self.chunkSize, w), np.nan, float) for w in state['widths']]
+        self.nBuffered = 0
+        self.nRows = state['rows']
+        self.tables = dict(state['tables'])
+        sizes = [self.nRows * state['widths'][j] * 8 if state['widths'] else 0 for j in range(len(self.files))]
+        for f, size in zip(self.files, sizes):
+            file = os.path.join(self.path, f)
+            if (os.path.getsize(file) if os.path.exists(file) else 0) < size:
+                raise ValueError('Cannot resume ' + self.path + ': ' + f + ' holds fewer rows than the checkpoint')
+        for f, size in zip(self.files, sizes):
+            with open(os.path.join(self.path, f), 'ab') as out:
+                out.truncate(size)
+        self.writeIndex()
+
+    def getColumn(self, j: int) -> np.ndarray:
+        # Widths are only known once a row has been logged, until then every column is an empty scalar
+        if not self.buffers:
+            return np.zeros((0, 1), float)
+        width = self.buffers[j].shape[1]
+        data = np.fromfile(os.path.join(self.path, self.files[j]), float, self.nRows * width).reshape(-1, width)
+        return np.concatenate((data, self.buffers[j][:self.nBuffered]))
+
+    def getTrackedData(self) -> DataFrame:
+        dic = {}
+        for j, c in enumerate(self.columns):
+            data = self.getColumn(j)
+            if data.shape[1] == 3:
+                dic.update({(c + ' - x'): data[:, 0], (c + ' - y'): data[:, 1], (c + ' - z'): data[:, 2]})
+            else:
+                dic.update({c: data[:, 0]})
+        return DataFrame(dic)
+
+    def getRawTrackedData(self) -> DataFrame:
+        dic = {}
+        for j, c in enumerate(self.columns):
+            data = self.getColumn(j)
+            dic.update({c: list(data) if data.shape[1] == 3 else data[:, 0]})
+        return DataFrame(dic)
+
+    def save(self, filename: str = None):
+        log('Flushing simulation data to ' + self.path + '... ', endLine = False)
+        self.flush()
+        for j, t in enumerate(self.tables):
+            self.getTable(t).to_csv(os.path.join(self.path, 'table' + str(j) + '.csv'), index = False)
+        self.writeIndex()
+        if filename is not None:
+            os.replace(self.path, filename)
+            self.path = filename
+        print('done')
+
+
 class ProgramLog:
     class MsgType(Enum):
         PRINT = 'Print'
@@ -0,0 +1,167 @@
+from Common import *
+from Fields import OscillatingField, UniformField
+
+
+class Diagnostic(ABC):
+
+    DIAGTYPE = 'Diagnostic'
+
+    def __init__(self, name: str = None):
+        self.ID = None
+        self.count = 0
+        if name is None:
+            self.name = self.DIAGTYPE
+        else:
+            self.name = name
+
+    @abstractmethod
+    def detect(self, r0: np.ndarray, r1: np.ndarray, t0: float, tStep: float, ids: np.ndarray) -> dict:
+        pass
+
+    @classmethod
+    def getRecord(cls, r0: np.ndarray, r1: np.ndarray, t0: float, tStep: float, ids: np.ndarray,
+                  hit: np.ndarray, s: np.ndarray) -> dict:
+        r = r0[hit] + s[:, None] * (r1[hit] - r0[hit])
+        return {'ID': ids[hit], 'Time': t0 + s * tStep,
+                'Position - x': r[:, 0], 'Position - y': r[:, 1], 'Position - z': r[:, 2]}
+
+    def getState(self) -> dict:
+        return {'count': self.count}
+
+    def setState(self, state: dict):
+        self.__dict__.update(state)
+
+    def getTypeName(self):
+        return self.DIAGTYPE
+
+    def __str__(self):
+        return self.name
+
+
+class GapCrossingDiagnostic(Diagnostic):
+
+    DIAGTYPE = 'Gap Crossing'
+
+    def __init__(self, region: AxisRegion, name: str = None):
+        super(GapCrossingDiagnostic, self).__init__(name = name)
+        self.region = region
+        self.centre = (region.b1 + region.b2) / 2
+
+    def detect(self, r0: np.ndarray, r1: np.ndarray, t0: float, tStep: float, ids: np.ndarray) -> dict:
+        x0 = r0[:, self.region.axis.value] - self.centre
+        x1 = r1[:, self.region.axis.value] - self.centre
+        hit = (x0 < 0) != (x1 < 0)
+        if not np.any(hit):
+            return None
+        s = x0[hit] / (x0[hit] - x1[hit])
+        record = self.getRecord(r0, r1, t0, tStep, ids, hit, s)
+        record.update({'Direction': np.sign(x1[hit] - x0[hit])})
+        self.count += len(s)
+        return record
+
+
+class TurnDiagnostic(Diagnostic):
+
+    DIAGTYPE = 'Turn'
+
+    def __init__(self, axis: Axis = Axis.Z, phase: float = 0, name: str = None):
+        super(TurnDiagnostic, self).__init__(name = name)
+        self.axis = axis
+        self.phase = phase
+        self.turns = np.zeros(0, int)
+
+    def getPlane(self, r: np.ndarray) -> np.ndarray:
+        perp = np.delete(r, self.axis.value, axis = 1)
+        return (perp[:, 0] + 1j * perp[:, 1]) * np.exp(-1j * self.phase)
+
+    def detect(self, r0: np.ndarray, r1: np.ndarray, t0: float, tStep: float, ids: np.ndarray) -> dict:
+        z0 = self.getPlane(r0)
+        z1 = self.getPlane(r1)
+        d0 = np.angle(z0)
+        d1 = np.angle(z1)
+        hit = ((d0 < 0) != (d1 < 0)) & (np.abs(d1 - d0) < PI) & (z0 != 0) & (z1 != 0)
+        if not np.any(hit):
+            return None
+        s = d0[hit] / (d0[hit] - d1[hit])
+        direction = np.sign(d1[hit] - d0[hit]).astype(int)
+        if len(self.turns) <= ids.max():
+            self.turns = np.concatenate((self.turns, np.zeros(ids.max() + 1 - len(self.turns), int)))
+        np.add.at(self.turns, ids[hit], direction)
+        record = self.getRecord(r0, r1, t0, tStep, ids, hit, s)
+        record.update({'Direction': direction, 'Turn': self.turns[ids[hit]]})
+        self.count += len(s)
+        return record
+
+    def getState(self) -> dict:
+        state = super(TurnDiagnostic, self).getState()
+        state.update({'turns': np.copy(self.turns)})
+        return state
+
+
+class RadiusDiagnostic(Diagnostic):
+
+    DIAGTYPE = 'Radius Reached'
+
+    def __init__(self, radius: float, axis: Axis = Axis.Z, name: str = None):
+        super(RadiusDiagnostic, self).__init__(name = name)
+        self.radius = radius
+        self.axis = axis
+
+    def getRadius(self, r: np.ndarray) -> np.ndarray:
+        perp = np.delete(r, self.axis.value, axis = 1)
+        return np.sqrt(np.einsum('ij,ij->i', perp, perp))
+
+    def detect(self, r0: np.ndarray, r1: np.ndarray, t0: float, tStep: float, ids: np.ndarray) -> dict:
+        rho0 = self.getRadius(r0)
+        rho1 = self.getRadius(r1)
+        hit = (rho0 < self.radius) & (rho1 >= self.radius)
+        if not np.any(hit):
+            return None
+        s = (self.radius - rho0[hit]) / (rho1[hit] - rho0[hit])
+        self.count += len(s)
+        return self.getRecord(r0, r1, t0, tStep, ids, hit, s)
+
+
+class PolarityDiagnostic(Diagnostic):
+
+    DIAGTYPE = 'Polarity Flip'
+
+    def __init__(self, field: UniformField, name: str = None):
+        super(PolarityDiagnostic, self).__init__(name = name)
+        self.field = field
+        self.reference = np.copy(field.fieldVector)
+        self.sign = 1.0
+
+    def getValue(self, time: float) -> float:
+        # Oscillating fields are evaluated at the step ends themselves, whatever time the field was last set to
+        if isinstance(self.field, OscillatingField):
+            return np.vdot(self.field.getVectorAt(time), self.reference)
+        return np.vdot(self.field.fieldVector, self.reference)
+
+    def getFlipFraction(self, t0: float, tStep: float, a: float, b: float) -> float:
+        zeros = self.field.waveform.getZeros() if isinstance(self.field, OscillatingField) else None
+        if zeros is not None and len(zeros):
+            # The phase is linear over the step, so the flip is at the last waveform zero it passes
+            p0 = self.field.getPhase(t0)
+            p1 = self.field.getPhase(t0 + tStep)
+            crossings = zeros + np.floor(p1 - zeros)
+            crossings = crossings[crossings > p0]
+            if p1 > p0 and len(crossings):
+                return (crossings.max() - p0) / (p1 - p0)
+        return a / (a - b)
+
+    def detect(self, r0: np.ndarray, r1: np.ndarray, t0: float, tStep: float, ids: np.ndarray) -> dict:
+        a = self.getValue(t0)
+        b = self.getValue(t0 + tStep)
+        sign = np.sign(b)
+        if sign == self.sign or sign == 0:
+            return None
+        self.sign = sign
+        self.count += 1
+        s = self.getFlipFraction(t0, tStep, a, b) if np.sign(a) != sign else 0.0
+        return {'Time': np.array([t0 + s * tStep], float), 'Polarity': np.array([sign], float)}
+
+    def getState(self) -> dict:
+        state = super(PolarityDiagnostic, self).getState()
+        state.update({'sign': self.sign})
+        return state
@@ -0,0 +1,112 @@
+from Common import *
+
+
+class Distribution(ABC):
+
+    DISTTYPE = 'Distribution'
+    BLOCK = 1 << 16
+
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+
+    @abstractmethod
+    def sampleBlock(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        pass
+
+    def sample(self, start: int, stop: int) -> np.ndarray:
+        # Every block has its own generator, so any slice of the bunch comes out the same however it is split up
+        out = np.empty((stop - start, 6), float)
+        for k in range(start // self.BLOCK, -(-stop // self.BLOCK)):
+            block = self.sampleBlock(np.random.default_rng([self.seed, k]), self.BLOCK)
+            lo = max(start, k * self.BLOCK)
+            hi = min(stop, (k + 1) * self.BLOCK)
+            out[lo - start:hi - start] = block[lo - k * self.BLOCK:hi - k * self.BLOCK]
+        return out
+
+    def getTypeName(self):
+        return self.DISTTYPE
+
+    def __str__(self):
+        return self.DISTTYPE + ' (seed ' + str(self.seed) + ')'
+
+
+class GaussianDistribution(Distribution):
+
+    DISTTYPE = 'Gaussian Distribution'
+
+    def __init__(self, sigmaR: np.array, sigmaP: np.array, cutoff: float = None, seed: int = 0):
+        super(GaussianDistribution, self).__init__(seed = seed)
+        self.sigma = np.concatenate((np.broadcast_to(sigmaR, 3), np.broadcast_to(sigmaP, 3))).astype(float)
+        self.cutoff = cutoff
+
+    def sampleBlock(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        z = rng.standard_normal((n, 6))
+        if self.cutoff is not None:
+            out = np.any(np.abs(z) > self.cutoff, axis = 1)
+            while np.any(out):
+                z[out] = rng.standard_normal((np.count_nonzero(out), 6))
+                out = np.any(np.abs(z) > self.cutoff, axis = 1)
+        return z * self.sigma
+
+
+class WaterbagDistribution(Distribution):
+
+    DISTTYPE = 'Waterbag Distribution'
+
+    def __init__(self, radiusR: np.array, radiusP: np.array, seed: int = 0):
+        super(WaterbagDistribution, self).__init__(seed = seed)
+        self.radius = np.concatenate((np.broadcast_to(radiusR, 3), np.broadcast_to(radiusP, 3))).astype(float)
+
+    def sampleBlock(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        z = rng.standard_normal((n, 6))
+        z *= (rng.random(n) ** (1 / 6) / np.linalg.norm(z, axis = 1))[:, None]
+        return z * self.radius
+
+
+class KVDistribution(Distribution):
+
+    DISTTYPE = 'KV Distribution'
+
+    def __init__(self, radiusR: np.array, radiusP: np.array, axis: Axis = Axis.Z, seed: int = 0):
+        super(KVDistribution, self).__init__(seed = seed)
+        self.radius = np.concatenate((np.broadcast_to(radiusR, 3), np.broadcast_to(radiusP, 3))).astype(float)
+        self.axis = axis
+
+    def sampleBlock(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        # Transverse planes sit on the surface of a 4D ellipsoid, the longitudinal plane fills an ellipse
+        transverse = [k for k in range(3) if k != self.axis.value]
+        z = np.empty((n, 6), float)
+        t = rng.standard_normal((n, 4))
+        t /= np.linalg.norm(t, axis = 1)[:, None]
+        z[:, transverse + [k + 3 for k in transverse]] = t
+        phi = 2 * PI * rng.random(n)
+        rho = np.sqrt(rng.random(n))
+        z[:, self.axis.value] = rho * np.cos(phi)
+        z[:, self.axis.value + 3] = rho * np.sin(phi)
+        return z * self.radius
+
+
+class FileDistribution(Distribution):
+
+    DISTTYPE = 'File Distribution'
+
+    def __init__(self, path: str):
+        super(FileDistribution, self).__init__(seed = None)
+        self.path = path
+        if path.endswith('.npy'):
+            self.data = np.load(path)
+        else:
+            self.data = np.loadtxt(path, delimiter = ',' if path.endswith('.csv') else None, ndmin = 2)
+        if self.data.ndim != 2 or self.data.shape[1] != 6:
+            raise ValueError('Expected rows of x, y, z, px, py, pz in ' + path + ', got shape ' + str(self.data.shape))
+
+    def sampleBlock(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        return self.data[:n]
+
+    def sample(self, start: int, stop: int) -> np.ndarray:
+        if stop > len(self.data):
+            raise ValueError(self.path + ' holds ' + str(len(self.data)) + ' particles, ' + str(stop) + ' requested')
+        return np.array(self.data[start:stop], float)
+
+    def __str__(self):
+        return self.DISTTYPE + ' from ' + self.path
@@ -1,10 +1,12 @@
 from Common import *
-from Particles import Particle
+from Particles import Particle, Bunch
 
 
 class Field(ABC):
 
     FIELDTYPE = ''
+    # Time-varying fields have the particles inside their region sub-cycled
+    TIMEVARYING = False
 
     def __init__(self, name = None):
         if name is None:
@@ -20,11 +22,17 @@ class Field(ABC):
     def getVector(self, point: np.array) -> np.array:
         pass
 
+    def getVectors(self, points: np.ndarray) -> np.ndarray:
+        return np.array([self.getVector(p) for p in points], float).reshape(-1, 3)
+
     def getMagnitude(self, point: np.array) -> float:
         return np.linalg.norm(self.getVector(point))
 
-    @abstractmethod
     def getForce(self, p: Particle) -> np.array:
+        return self.getForces(np.array([p.r], float), np.array([p.v], float), np.array([p.q], float))[0]
+
+    @abstractmethod
+    def getForces(self, positions: np.ndarray, velocities: np.ndarray, charges: np.ndarray) -> np.ndarray:
         pass
 
     @abstractmethod
@@ -36,9 +44,27 @@ class Field(ABC):
         pass
 
     @abstractmethod
-    def tick(self):
+    def tick(self, tStep: float = None):
         pass
 
+    def setTime(self, time: float):
+        return
+
+    def getState(self) -> dict:
+        return {}
+
+    def setState(self, state: dict):
+        self.__dict__.update(state)
+
+    def getSyncState(self) -> dict:
+        return self.getState()
+
+    def setSyncState(self, state: dict):
+        self.setState(state)
+
+    def beginSync(self):
+        return
+
     def __str__(self):
         return self.name
 
@@ -53,10 +79,17 @@ class UniformField(Field, ABC):
         self.region = region
 
     def getVector(self, point: np.array):
-        if self.region.contains(point):
-            return self.fieldVector
-        else:
-            return np.array([0, 0, 0], float)
+        return self.getVectors(np.array([point], float))[0]
+
+    def getVectors(self, points: np.ndarray):
+        vectors = np.zeros((len(points), 3), float)
+        vectors[self.region.containsMany(points)] = self.fieldVector
+        return vectors
+
+    def getState(self):
+        state = super(UniformField, self).getState()
+        state.update({'fieldVector': np.copy(self.fieldVector)})
+        return state
 
     def __str__(self):
         return self.name + ' with uniform field vector ' + str(self.fieldVector)
@@ -69,15 +102,15 @@ class ConstantField(Field, ABC):
     def update(self):
         return
 
-    def tick(self):
+    def tick(self, tStep: float = None):
         return
 
 
 class BField(Field, ABC):
     FIELDTYPE = 'Magnetic Field'
 
-    def getForce(self, p: Particle):
-        return p.q * np.cross(p.v, self.getVector(p.r))
+    def getForces(self, positions: np.ndarray, velocities: np.ndarray, charges: np.ndarray):
+        return charges[:, None] * np.cross(velocities, self.getVectors(positions))
 
     def getPotentialEnergy(self, p: Particle):
         pass
@@ -96,8 +129,8 @@ class EField(Field, ABC):
 
     nor = 1 / (4 * PI * EPSILON0)
 
-    def getForce(self, p: Particle):
-        return p.q * self.getVector(p.r)
+    def getForces(self, positions: np.ndarray, velocities: np.ndarray, charges: np.ndarray):
+        return charges[:, None] * self.getVectors(positions)
 
     @abstractmethod
     def getPotential(self, point: np.array) -> float:
@@ -107,25 +140,148 @@ class EField(Field, ABC):
         return p.q * self.getPotential(p)
 
 
+class StaticFieldGroup:
+
+    @classmethod
+    def isStatic(cls, f: Field) -> bool:
+        return isinstance(f, ConstantField) and isinstance(f, UniformField) and isinstance(f, (EField, BField))
+
+    def __init__(self, region: Region):
+        self.region = region
+        self.fields: List[Field] = []
+        self.E = np.zeros(3, float)
+        self.B = np.zeros(3, float)
+
+    def add(self, f: Field):
+        self.fields.append(f)
+        if isinstance(f, BField):
+            self.B = self.B + f.fieldVector
+        else:
+            self.E = self.E + f.fieldVector
+
+    def getForce(self, p: Particle) -> np.ndarray:
+        forces = np.zeros((1, 3), float)
+        self.addForces(np.array([p.r], float), np.array([p.v], float), np.array([p.q], float), forces)
+        return forces[0]
+
+    def getMask(self, points: np.ndarray, idx: np.ndarray = None):
+        if idx is None:
+            if isinstance(self.region, AllRegion):
+                return slice(None)
+            return self.region.containsMany(points)
+        return idx[self.region.containsMany(points[idx])]
+
+    def addForces(self, positions: np.ndarray, velocities: np.ndarray, charges: np.ndarray, forces: np.ndarray,
+                  idx: np.ndarray = None):
+        mask = self.getMask(positions, idx)
+        forces[mask] += charges[mask][:, None] * (self.E + np.cross(velocities[mask], self.B))
+
+    def addVectors(self, points: np.ndarray, E: np.ndarray, B: np.ndarray, idx: np.ndarray = None):
+        mask = self.getMask(points, idx)
+        E[mask] += self.E
+        B[mask] += self.B
+
+    def __str__(self):
+        return str(len(self.fields)) + ' static fields with E = ' + str(self.E) + ', B = ' + str(self.B)
+
+
+class Waveform(ABC):
+
+    @abstractmethod
+    def __call__(self, phase: float) -> float:
+        pass
+
+    def getZeros(self) -> np.ndarray:
+        # Phases in [0, 1) where the waveform changes sign, if known
+        return None
+
+
+class SineWaveform(Waveform):
+
+    def __init__(self, offset: float = 0):
+        self.offset = offset
+
+    def __call__(self, phase: float) -> float:
+        return np.cos(2 * PI * phase + self.offset)
+
+    def getZeros(self) -> np.ndarray:
+        return (np.array([0.25, 0.75]) - self.offset / (2 * PI)) % 1
+
+
+class StepWaveform(Waveform):
+
+    def __call__(self, phase: float) -> float:
+        return 1.0 if phase % 1 < 0.5 else -1.0
+
+    def getZeros(self) -> np.ndarray:
+        return np.array([0, 0.5])
+
+
+class TableWaveform(Waveform):
+
+    def __init__(self, phases: np.ndarray, values: np.ndarray):
+        self.phases = np.asarray(phases, float) % 1
+        order = np.argsort(self.phases)
+        self.phases = self.phases[order]
+        self.values = np.asarray(values, float)[order]
+
+    def __call__(self, phase: float) -> float:
+        return float(np.interp(phase % 1, self.phases, self.values, period = 1))
+
+    def getZeros(self) -> np.ndarray:
+        # Linear segments between consecutive table points, the last one wrapping around to the first
+        p0, p1 = self.phases, np.append(self.phases[1:], self.phases[0] + 1)
+        v0, v1 = self.values, np.append(self.values[1:], self.values[0])
+        cross = np.sign(v0) != np.sign(v1)
+        return (p0[cross] + v0[cross] / (v0[cross] - v1[cross]) * (p1[cross] - p0[cross])) % 1
+
+
 class OscillatingField(UniformField, ABC):
 
     FIELDTYPE = 'Oscillating Field'
+    TIMEVARYING = True
 
-    def __init__(self, maxFieldVector: np.array, period: float, tStep: float, region: Region = ALL_SPACE, name = ""):
+    def __init__(self, maxFieldVector: np.array, period: float, tStep: float, region: Region = ALL_SPACE, name = "",
+                 waveform: Waveform = None):
         super(OscillatingField, self).__init__(fieldVector = maxFieldVector, region = region, name = name)
+        self.maxFieldVector = np.array(maxFieldVector, float)
+        self.waveform = SineWaveform() if waveform is None else waveform
         self.period = period
         self.tStep = tStep
+        # Phase (in cycles) is linear in time between anchors, which move whenever the period changes
+        self.anchorTime = float(0)
+        self.anchorPhase = float(0)
         self.t = float(0)
+        self.setTime(0)
 
-    def tick(self):
-        if self.t > self.period:
-            self.t -= self.period
-        else:
-            self.t += self.tStep
+    def getPhase(self, time: float) -> float:
+        return self.anchorPhase + (time - self.anchorTime) / self.period
+
+    def setPeriod(self, period: float):
+        self.anchorPhase = self.getPhase(self.t)
+        self.anchorTime = self.t
+        self.period = period
+
+    def getVectorAt(self, time: float) -> np.ndarray:
+        return self.waveform(self.getPhase(time)) * self.maxFieldVector
+
+    def setTime(self, time: float):
+        self.t = time
+        self.fieldVector = self.getVectorAt(time)
+
+    def tick(self, tStep: float = None):
+        if tStep is None:
+            tStep = self.tStep
+        self.setTime(self.t + tStep)
 
-    @abstractmethod
     def update(self):
-        pass
+        return
+
+    def getState(self):
+        state = super(OscillatingField, self).getState()
+        state.update({'t': self.t, 'period': self.period, 'anchorTime': self.anchorTime,
+                      'anchorPhase': self.anchorPhase})
+        return state
 
     def __str__(self):
         return self.name + ' with uniform field vector ' + str(self.fieldVector) + ' and period ' + str(self.period)
@@ -137,18 +293,12 @@ class StepOscillatingField(OscillatingField, ABC):
 
     def __init__(self, maxFieldVector: np.array, period: float, tStep: float, region: Region = ALL_SPACE, name = ""):
         super(StepOscillatingField, self).__init__(maxFieldVector = maxFieldVector, period = period,
-                                                   tStep = tStep, region = region, name = name)
-        self.halfPeriod = period / 2
-
-    def tick(self):
-        if self.t > self.halfPeriod:
-            self.t -= self.halfPeriod
-        else:
-            self.t += self.tStep
+                                                   tStep = tStep, region = region, name = name,
+                                                   waveform = StepWaveform())
 
-    def update(self):
-        if self.t > self.halfPeriod:
-            self.fieldVector = -self.fieldVector
+    @property
+    def halfPeriod(self) -> float:
+        return self.period / 2
 
 
 class CyclotronEField(StepOscillatingField, EField):
@@ -179,12 +329,14 @@ class SynchroCyclotronEField(CyclotronEField):
         self.T0 = self.period
 
     def update(self):
-        self.halfPeriod = self.refObj.getGamma() * self.T0 / 2
-        if self.t > self.halfPeriod:
-            self.fieldVector = -self.fieldVector
+        # An emptied reference bunch has no mean gamma, so the last period is held
+        gamma = self.refObj.getGamma()
+        if np.isfinite(gamma):
+            self.setPeriod(gamma * self.T0)
 
 class IsoCyclotronBField(UniformBField):
     FIELDTYPE = 'Isocyclotronic Uniform B-Field'
+    TIMEVARYING = True
 
     def __init__(self, fieldVector: np.ndarray, referenceObject: TrackableObject,
                  region: Region = ALL_SPACE, name = None):
@@ -193,11 +345,209 @@ class IsoCyclotronBField(UniformBField):
         self.B0 = fieldVector
 
     def update(self):
-        self.fieldVector = self.refObj.getGamma() * self.B0
+        gamma = self.refObj.getGamma()
+        if np.isfinite(gamma):
+            self.fieldVector = gamma * self.B0
 
-    def tick(self):
+    def tick(self, tStep: float = None):
         pass
 
+class RadialMapBField(BField, ConstantField):
+    FIELDTYPE = 'Radial Field-Map B-Field'
+
+    @classmethod
+    def isochronous(cls, B0: float, partType: Type[Particle], rMax: float, nRadii: int = 512, axis: Axis = Axis.Z,
+                    region: Region = ALL_SPACE, name = None) -> 'RadialMapBField':
+        # Revolution frequency qB0/m stays fixed when B rises with gamma(r) = 1 / sqrt(1 - (qB0 r / m)^2)
+        omega = partType.getCharge() * B0 / partType.getRestMass()
+        if abs(omega) * rMax >= 1:
+            raise ValueError('Isochronous orbit at r = ' + str(rMax) + ' would exceed the speed of light')
+        radii = np.linspace(0, rMax, nRadii)
+        return cls(radii, B0 / np.sqrt(1 - (omega * radii) ** 2), axis = axis, region = region, name = name)
+
+    @classmethod
+    def fromFile(cls, path: str, axis: Axis = Axis.Z, region: Region = ALL_SPACE, name = None) -> 'RadialMapBField':
+        if path.endswith('.npz'):
+            with np.load(path) as data:
+                thetas = data['thetas'] if 'thetas' in data else None
+                return cls(data['radii'], data['values'], thetas, axis = axis, region = region, name = name)
+        table = np.loadtxt(path, delimiter = ',' if path.endswith('.csv') else None, ndmin = 2)
+        return cls(table[:, 0], table[:, 1], axis = axis, region = region, name = name)
+
+    def __init__(self, radii: np.ndarray, values: np.ndarray, thetas: np.ndarray = None, axis: Axis = Axis.Z,
+                 region: Region = ALL_SPACE, name = None):
+        super(RadialMapBField, self).__init__(name = name)
+        self.radii = np.asarray(radii, float)
+        self.values = np.asarray(values, float).reshape(len(self.radii), -1)
+        if thetas is None:
+            self.thetas = None
+            if self.values.shape[1] != 1:
+                raise ValueError('Field map has ' + str(self.values.shape[1]) + ' azimuthal columns but no angles')
+        else:
+            self.thetas = np.asarray(thetas, float)
+            if len(self.thetas) != self.values.shape[1]:
+                raise ValueError('Field map has ' + str(self.values.shape[1]) + ' azimuthal columns but ' +
+                                 str(len(self.thetas)) + ' angles')
+            # Angles wrap around, so the last one must stay short of the first one's next turn
+            if np.any(np.diff(self.thetas) <= 0) or self.thetas[-1] - self.thetas[0] >= 2 * PI:
+                raise ValueError('Field map angles must be strictly increasing within one turn')
+        if self.radii.ndim != 1 or len(self.radii) < 2:
+            raise ValueError('Field map needs at least two radii, got ' + str(self.radii.size))
+        if np.any(np.diff(self.radii) <= 0):
+            raise ValueError('Field map radii must be strictly increasing')
+        self.axis = axis
+        self.region = region
+        self.direction = np.eye(3)[axis.value]
+        self.fieldVector = self.values[0].mean() * self.direction
+
+    def getMagnitudes(self, points: np.ndarray) -> np.ndarray:
+        perp = np.delete(points, self.axis.value, axis = 1)
+        rho = np.sqrt(np.einsum('ij,ij->i', perp, perp))
+        i = np.clip(np.searchsorted(self.radii, rho) - 1, 0, len(self.radii) - 2)
+        u = np.clip((rho - self.radii[i]) / (self.radii[i + 1] - self.radii[i]), 0, 1)
+        if self.thetas is None:
+            return (1 - u) * self.values[i, 0] + u * self.values[i + 1, 0]
+        theta = np.mod(np.arctan2(perp[:, 1], perp[:, 0]) - self.thetas[0], 2 * PI) + self.thetas[0]
+        period = np.append(self.thetas, self.thetas[0] + 2 * PI)
+        j = np.clip(np.searchsorted(period, theta, side = 'right') - 1, 0, len(self.thetas) - 1)
+        w = (theta - period[j]) / (period[j + 1] - period[j])
+        k = (j + 1) % len(self.thetas)
+        return ((1 - u) * ((1 - w) * self.values[i, j] + w * self.values[i, k]) +
+                u * ((1 - w) * self.values[i + 1, j] + w * self.values[i + 1, k]))
+
+    def getVector(self, point: np.array):
+        return self.getVectors(np.array([point], float))[0]
+
+    def getVectors(self, points: np.ndarray):
+        vectors = self.getMagnitudes(points)[:, None] * self.direction
+        vectors[~self.region.containsMany(points)] = 0
+        return vectors
+
+    def __str__(self):
+        return self.name + ' over r in [' + str(self.radii[0]) + ', ' + str(self.radii[-1]) + ']' + (
+            '' if self.thetas is None else ' with ' + str(len(self.thetas)) + ' azimuthal samples')
+
+
+class FieldMap:
+
+    @classmethod
+    def getPath(cls, path: str) -> str:
+        # np.save appends .npy to any other path, so the loader and sidecar must too
+        return path if path.endswith('.npy') else path + '.npy'
+
+    @classmethod
+    def getSidecar(cls, path: str) -> str:
+        return cls.getPath(path)[:-len('.npy')] + '.json'
+
+    @classmethod
+    def save(cls, path: str, grid: np.ndarray, origin: np.array, spacing: np.array) -> str:
+        grid = np.asarray(grid, float)
+        if grid.ndim != 4 or grid.shape[3] != 3:
+            raise ValueError('Field map grid must have shape (nx, ny, nz, 3), got ' + str(grid.shape))
+        path = cls.getPath(path)
+        np.save(path, grid)
+        with open(cls.getSidecar(path), 'w') as f:
+            json.dump({'origin': list(np.broadcast_to(origin, 3).astype(float)),
+                       'spacing': list(np.broadcast_to(spacing, 3).astype(float))}, f)
+        return path
+
+    def __init__(self, path: str, order: int = 1):
+        if order not in (1, 3):
+            raise ValueError('Field map interpolation order must be 1 (trilinear) or 3 (tricubic)')
+        self.path = self.getPath(path)
+        self.order = order
+        self.open()
+
+    def open(self):
+        self.grid = np.load(self.path, mmap_mode = 'r')
+        with open(self.getSidecar(self.path)) as f:
+            meta = json.load(f)
+        self.origin = np.array(meta['origin'], float)
+        self.spacing = np.array(meta['spacing'], float)
+        self.shape = np.array(self.grid.shape[:3], int)
+
+    def __getstate__(self):
+        return {'path': self.path, 'order': self.order}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def interpolate(self, points: np.ndarray) -> np.ndarray:
+        u = (points - self.origin) / self.spacing
+        inside = np.all((u >= 0) & (u <= self.shape - 1), axis = 1)
+        vectors = np.zeros((len(points), 3), float)
+        if not np.any(inside):
+            return vectors
+        u = u[inside]
+        if self.order == 1:
+            vectors[inside] = self.trilinear(u)
+            return vectors
+        # Cells next to the boundary lack the outer stencil points, so they fall back to trilinear
+        edge = np.any((u < 1) | (u >= self.shape - 2), axis = 1)
+        out = np.empty((len(u), 3), float)
+        out[edge] = self.trilinear(u[edge])
+        out[~edge] = self.tricubic(u[~edge])
+        vectors[inside] = out
+        return vectors
+
+    def trilinear(self, u: np.ndarray) -> np.ndarray:
+        i = np.minimum(np.floor(u).astype(int), self.shape - 2)
+        f = u - i
+        return self.accumulate(i, [1 - f, f])
+
+    def tricubic(self, u: np.ndarray) -> np.ndarray:
+        i = np.floor(u).astype(int) - 1
+        f = u - i - 1
+        f2 = f * f
+        f3 = f2 * f
+        return self.accumulate(i, [(-f3 + 2 * f2 - f) / 2, (3 * f3 - 5 * f2 + 2) / 2, (-3 * f3 + 4 * f2 + f) / 2,
+                                   (f3 - f2) / 2])
+
+    def accumulate(self, i: np.ndarray, weights: List[np.ndarray]) -> np.ndarray:
+        out = np.zeros((len(i), 3), float)
+        for a, wx in enumerate(weights):
+            for b, wy in enumerate(weights):
+                wxy = wx[:, 0] * wy[:, 1]
+                for c, wz in enumerate(weights):
+                    out += (wxy * wz[:, 2])[:, None] * self.grid[i[:, 0] + a, i[:, 1] + b, i[:, 2] + c]
+        return out
+
+    def __str__(self):
+        return self.path + ' (' + 'x'.join(str(k) for k in self.shape) + ', ' + (
+            'trilinear' if self.order == 1 else 'tricubic') + ')'
+
+
+class MapField(ConstantField, ABC):
+
+    def __init__(self, path: str, order: int = 1, region: Region = ALL_SPACE, name = None):
+        super(MapField, self).__init__(name = name)
+        self.map = FieldMap(path, order)
+        self.region = region
+
+    def getVector(self, point: np.array):
+        return self.getVectors(np.array([point], float))[0]
+
+    def getVectors(self, points: np.ndarray):
+        vectors = self.map.interpolate(points)
+        vectors[~self.region.containsMany(points)] = 0
+        return vectors
+
+    def __str__(self):
+        return self.name + ' from ' + str(self.map)
+
+
+class MapBField(MapField, BField):
+    FIELDTYPE = 'Field-Map B-Field'
+
+
+class MapEField(MapField, EField):
+    FIELDTYPE = 'Field-Map E-Field'
+
+    def getPotential(self, point: np.array):
+        pass
+
+
 class ParticleField(Field, ABC):
     FIELDTYPE = 'Particle Field'
 
@@ -221,6 +571,299 @@ class ParticleEField(ParticleField, EField, ConstantField):
         return self.source.q / r
 
 
+class SpaceChargeEField(EField):
+
+    FIELDTYPE = 'Space-Charge E-Field'
+    # Mean of 1/r over a unit cube, used for the self-cell of the Green's function
+    CELL_SELF = 2.38
+
+    def __init__(self, sources: List[Bunch], gridShape = (32, 32, 32), padding: float = 0.1,
+                 tickInterval: int = 1, minExtent: float = 1e-3, name = None):
+        super(SpaceChargeEField, self).__init__(name)
+        self.sources = sources
+        self.gridShape = np.array(gridShape, int)
+        self.padding = padding
+        self.tickInterval = tickInterval
+        self.minExtent = minExtent
+        self.ticks = 0
+        self.version = 0
+        self.synced: int = None
+        self.origin: np.ndarray = None
+        self.spacing: np.ndarray = None
+        self.phi: np.ndarray = None
+        self.E: np.ndarray = None
+        self.centroid = np.zeros(3, float)
+        self.totalCharge = float(0)
+
+    def getSources(self):
+        r = []
+        q = []
+        for b in self.sources:
+            arrays = b.getArrays()
+            r.append(arrays[0])
+            q.append(arrays[5])
+        return np.concatenate(r), np.concatenate(q)
+
+    def getCellWeights(self, points: np.ndarray):
+        f = (points - self.origin) / self.spacing
+        i = np.clip(np.floor(f).astype(int), 0, self.gridShape - 2)
+        return i, f - i
+
+    def solve(self):
+        self.version += 1
+        r, q = self.getSources()
+        if len(q) == 0:
+            r = np.zeros((1, 3), float)
+            q = np.zeros(1, float)
+        lo = r.min(axis = 0)
+        hi = r.max(axis = 0)
+        extent = np.maximum(hi - lo, self.minExtent) * (1 + 2 * self.padding)
+        self.origin = (lo + hi) / 2 - extent / 2
+        self.spacing = extent / (self.gridShape - 1)
+        self.totalCharge = q.sum()
+        if np.abs(q).sum() > 0:
+            self.centroid = (np.abs(q)[:, None] * r).sum(axis = 0) / np.abs(q).sum()
+        else:
+            self.centroid = r.mean(axis = 0)
+
+        i, w = self.getCellWeights(r)
+        charge = np.zeros(self.gridShape, float)
+        for corner in np.ndindex(2, 2, 2):
+            c = np.array(corner)
+            weight = np.prod(np.where(c == 1, w, 1 - w), axis = 1)
+            np.add.at(charge, tuple((i + c).T), q * weight)
+
+        # Hockney's method: convolve with the free-space Green's function on a doubled grid
+        n = self.gridShape
+        axes = [np.where(np.arange(2 * k) < k, np.arange(2 * k), np.arange(2 * k) - 2 * k) * h
+                for k, h in zip(n, self.spacing)]
+        x, y, z = np.meshgrid(*axes, indexing = 'ij')
+        d = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+        d[0, 0, 0] = 1
+        green = 1 / d
+        green[0, 0, 0] = self.CELL_SELF / np.cbrt(np.prod(self.spacing))
+        phi = np.fft.irfftn(np.fft.rfftn(charge, s = 2 * n) * np.fft.rfftn(green), s = 2 * n)
+        self.phi = phi[:n[0], :n[1], :n[2]]
+        self.E = -np.stack(np.gradient(self.phi, *self.spacing), axis = -1)
+
+    def interpolate(self, grid: np.ndarray, points: np.ndarray) -> np.ndarray:
+        i, w = self.getCellWeights(points)
+        out = np.zeros((len(points),) + grid.shape[3:], float)
+        for corner in np.ndindex(2, 2, 2):
+            c = np.array(corner)
+            weight = np.prod(np.where(c == 1, w, 1 - w), axis = 1)
+            out += weight.reshape((-1,) + (1,) * (grid.ndim - 3)) * grid[tuple((i + c).T)]
+        return out
+
+    def getOutside(self, points: np.ndarray) -> np.ndarray:
+        upper = self.origin + self.spacing * (self.gridShape - 1)
+        return np.any((points < self.origin) | (points > upper), axis = 1)
+
+    def getVectors(self, points: np.ndarray):
+        if self.E is None:
+            self.solve()
+        vectors = self.interpolate(self.E, points)
+        outside = self.getOutside(points)
+        if np.any(outside) and self.totalCharge == 0:
+            vectors[outside] = 0
+        elif np.any(outside):
+            d = points[outside] - self.centroid
+            d2 = np.einsum('ij,ij->i', d, d)
+            vectors[outside] = self.totalCharge * d / (d2 * np.sqrt(d2))[:, None]
+        return vectors
+
+    def getVector(self, point: np.array):
+        return self.getVectors(np.array([point], float))[0]
+
+    def getPotential(self, point: np.array):
+        if self.phi is None:
+            self.solve()
+        if self.getOutside(np.array([point], float))[0]:
+            return self.totalCharge / np.linalg.norm(point - self.centroid)
+        return self.interpolate(self.phi, np.array([point], float))[0]
+
+    def update(self):
+        if self.ticks % self.tickInterval == 0:
+            self.solve()
+
+    def getState(self):
+        return {'ticks': self.ticks, 'origin': self.origin, 'spacing': self.spacing, 'phi': self.phi, 'E': self.E,
+                'centroid': self.centroid, 'totalCharge': self.totalCharge}
+
+    def getSyncState(self):
+        return {'ticks': self.ticks, 'version': self.version}
+
+    def setSyncState(self, state: dict):
+        # Shards re-solve from the shared particle arrays whenever the main process has, instead of receiving the grids
+        self.ticks = state['ticks']
+        if state['version'] != self.synced:
+            self.solve()
+            self.synced = state['version']
+
+    def beginSync(self):
+        # Forked shards inherit the grids as solved so far
+        self.synced = self.version
+
+    def tick(self, tStep: float = None):
+        self.ticks += 1
+
+    def __str__(self):
+        return self.name + ' on a ' + 'x'.join(str(k) for k in self.gridShape) + ' grid'
+
+
+class TreeCoulombEField(EField):
+
+    FIELDTYPE = 'Barnes-Hut Coulomb E-Field'
+
+    def __init__(self, sources: List[Bunch], theta: float = 0.5, leafSize: int = 16, softening: float = 0.0,
+                 maxDepth: int = 32, name = None):
+        super(TreeCoulombEField, self).__init__(name)
+        self.sources = sources
+        self.theta = theta
+        self.leafSize = leafSize
+        self.maxDepth = maxDepth
+        self.softening = softening
+        self.r: np.ndarray = None
+        self.q: np.ndarray = None
+        self.sizes = None
+        self.charges = None
+        self.centres = None
+        self.children: List[List[int]] = []
+        self.members: List[np.ndarray] = []
+        self.version = 0
+        self.synced: int = None
+
+    def getSources(self):
+        r = []
+        q = []
+        for b in self.sources:
+            arrays = b.getArrays()
+            r.append(arrays[0])
+            q.append(arrays[5])
+        return np.array(np.concatenate(r)), np.array(np.concatenate(q))
+
+    def addNode(self, idx: np.ndarray, half: float) -> int:
+        q = self.q[idx]
+        w = np.abs(q)
+        r = self.r[idx]
+        self.sizes.append(2 * half)
+        self.charges.append(q.sum())
+        if w.sum() > 0:
+            self.centres.append((w[:, None] * r).sum(axis = 0) / w.sum())
+        elif len(r) > 0:
+            self.centres.append(r.mean(axis = 0))
+        else:
+            self.centres.append(np.zeros(3, float))
+        self.children.append([])
+        self.members.append(None)
+        return len(self.children) - 1
+
+    def build(self):
+        self.version += 1
+        self.r, self.q = self.getSources()
+        if len(self.r) > 0:
+            lo = self.r.min(axis = 0)
+            hi = self.r.max(axis = 0)
+        else:
+            lo = hi = np.zeros(3, float)
+        self.sizes = []
+        self.charges = []
+        self.centres = []
+        self.children = []
+        self.members = []
+        idx = np.arange(len(self.r))
+        half = np.max(hi - lo) / 2
+        stack = [(self.addNode(idx, half), idx, (lo + hi) / 2, half, 0)]
+        while stack:
+            node, idx, mid, half, depth = stack.pop()
+            # Coincident particles never separate, so past maxDepth a crowded cell stays a multi-particle leaf
+            if len(idx) <= self.leafSize or half == 0 or depth >= self.maxDepth:
+                self.members[node] = idx
+                continue
+            octant = ((self.r[idx] > mid) * np.array([1, 2, 4])).sum(axis = 1)
+            for o in range(8):
+                sub = idx[octant == o]
+                if len(sub) > 0:
+                    offset = np.array([1 if o & k else -1 for k in (1, 2, 4)], float)
+                    child = self.addNode(sub, half / 2)
+                    self.children[node].append(child)
+                    stack.append((child, sub, mid + offset * half / 2, half / 2, depth + 1))
+        self.sizes = np.array(self.sizes)
+        self.charges = np.array(self.charges)
+        self.centres = np.array(self.centres)
+
+    def evaluate(self, points: np.ndarray, potential = False) -> np.ndarray:
+        if self.r is None:
+            self.build()
+        if potential:
+            out = np.zeros(len(points), float)
+        else:
+            out = np.zeros((len(points), 3), float)
+        eps2 = self.softening ** 2
+        stack = [(0, np.arange(len(points)))]
+        while stack:
+            node, idx = stack.pop()
+            members = self.members[node]
+            if members is not None:
+                d = points[idx][:, None, :] - self.r[members][None, :, :]
+                d2 = np.einsum('ijk,ijk->ij', d, d)
+                valid = d2 > 0
+                inv = np.zeros_like(d2)
+                inv[valid] = 1 / np.sqrt(d2[valid] + eps2)
+                if potential:
+                    out[idx] += (self.q[members] * inv).sum(axis = 1)
+                else:
+                    out[idx] += np.einsum('ij,ijk->ik', self.q[members] * inv ** 3, d)
+                continue
+            d = points[idx] - self.centres[node]
+            d2 = np.einsum('ij,ij->i', d, d) + eps2
+            far = self.sizes[node] ** 2 < self.theta ** 2 * d2
+            if np.any(far):
+                inv = 1 / np.sqrt(d2[far])
+                if potential:
+                    out[idx[far]] += self.charges[node] * inv
+                else:
+                    out[idx[far]] += self.charges[node] * d[far] * (inv ** 3)[:, None]
+            near = idx[~far]
+            if len(near) > 0:
+                for c in self.children[node]:
+                    stack.append((c, near))
+        return out
+
+    def getVectors(self, points: np.ndarray):
+        return self.evaluate(points)
+
+    def getVector(self, point: np.array):
+        return self.evaluate(np.array([point], float))[0]
+
+    def getPotential(self, point: np.array):
+        return self.evaluate(np.array([point], float), potential = True)[0]
+
+    def update(self):
+        self.build()
+
+    def getState(self):
+        return {'r': self.r, 'q': self.q, 'sizes': self.sizes, 'charges': self.charges, 'centres': self.centres,
+                'children': self.children, 'members': self.members}
+
+    def getSyncState(self):
+        return {'version': self.version}
+
+    def setSyncState(self, state: dict):
+        if state['version'] != self.synced:
+            self.build()
+            self.synced = state['version']
+
+    def beginSync(self):
+        self.synced = self.version
+
+    def tick(self, tStep: float = None):
+        return
+
+    def __str__(self):
+        return self.name + ' with opening angle ' + str(self.theta)
+
+
 class FieldPoint(Trackable):
 
     class Property(TrackableProperty):
@@ -1,12 +1,275 @@
-from copy import deepcopy
+from multiprocessing.shared_memory import SharedMemory
 
 from Common import *
+from Distributions import Distribution
+
+
+class ParticleArrays:
+    STATE = ('r', 'v', 'a', 'rNext', 'vNext', 'aNext', 'gam', 'gamNext', 'm', 'q', 'F')
+    # Dormand-Prince 5(4) tableau
+    RK45_C = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1])
+    RK45_A = [[],
+              [1 / 5],
+              [3 / 40, 9 / 40],
+              [44 / 45, -56 / 15, 32 / 9],
+              [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+              [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+              [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]]
+    RK45_B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0])
+    RK45_E = RK45_B - np.array([5179 / 57600, 0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40])
+
+    @classmethod
+    def calcGamma(cls, v: np.ndarray) -> np.ndarray:
+        return 1 / np.sqrt(1 - np.einsum('ij,ij->i', v, v))
+
+    @classmethod
+    def fromParticles(cls, particles: List['Particle'], shared = False) -> 'ParticleArrays':
+        arrays = cls(len(particles), shared)
+        i = 0
+        while i < len(particles):
+            # Copy runs of particles that already sit next to each other in one set of arrays as a block
+            source = particles[i].arrays
+            start = particles[i].index - i
+            j = i + 1
+            while j < len(particles) and particles[j].arrays is source and particles[j].index == start + j:
+                j += 1
+            for k in cls.STATE:
+                getattr(arrays, k)[i:j] = getattr(source, k)[start + i:start + j]
+            for n in range(i, j):
+                particles[n].arrays = arrays
+                particles[n].index = n
+            i = j
+        arrays.rNext[:] = arrays.r
+        arrays.vNext[:] = arrays.v
+        arrays.aNext[:] = arrays.a
+        arrays.gamNext[:] = arrays.gam
+        arrays.bunches = list({id(p.bunch): p.bunch for p in particles if p.bunch is not None}.values())
+        for b in arrays.bunches:
+            b.view = None
+            b.invalidate()
+        return arrays
+
+    def __init__(self, N: int, shared = False):
+        self.N = N
+        self.blocks: List[SharedMemory] = [] if shared else None
+        self.r = self.allocate((N, 3), 0)
+        self.v = self.allocate((N, 3), 0)
+        self.a = self.allocate((N, 3), 0)
+        self.rNext = self.allocate((N, 3), 0)
+        self.vNext = self.allocate((N, 3), 0)
+        self.aNext = self.allocate((N, 3), 0)
+        self.gam = self.allocate((N,), 1)
+        self.gamNext = self.allocate((N,), 1)
+        self.m = self.allocate((N,), 0)
+        self.q = self.allocate((N,), 0)
+        self.F = self.allocate((N, 3), 0)
+        self.bunches: List[Bunch] = []
+
+    def allocate(self, shape: tuple, fill: float) -> np.ndarray:
+        if self.blocks is None:
+            return np.full(shape, fill, float)
+        block = SharedMemory(create = True, size = max(int(np.prod(shape)) * 8, 8))
+        self.blocks.append(block)
+        array = np.ndarray(shape, float, buffer = block.buf)
+        array[...] = fill
+        return array
+
+    def release(self):
+        if self.blocks is None:
+            return
+        for k in self.STATE:
+            setattr(self, k, np.copy(getattr(self, k)))
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = None
+
+    def shard(self, start: int, stop: int) -> 'ParticleArrays':
+        view = ParticleArrays.__new__(ParticleArrays)
+        view.N = stop - start
+        view.blocks = None
+        for k in self.STATE:
+            setattr(view, k, getattr(self, k)[start:stop])
+        view.bunches = []
+        return view
+
+    def invalidate(self):
+        for b in self.bunches:
+            b.invalidate()
+
+    def getState(self) -> dict:
+        return {k: np.copy(getattr(self, k)) for k in self.STATE}
+
+    def setState(self, state: dict):
+        for k in self.STATE:
+            getattr(self, k)[...] = state[k]
+        self.invalidate()
+
+    def take(self, sel: np.ndarray) -> 'ParticleArrays':
+        sub = ParticleArrays(int(np.count_nonzero(sel)))
+        for k in self.STATE:
+            getattr(sub, k)[:] = getattr(self, k)[sel]
+        return sub
+
+    def putNext(self, sel: np.ndarray, sub: 'ParticleArrays'):
+        self.rNext[sel] = sub.r
+        self.vNext[sel] = sub.v
+        self.aNext[sel] = sub.a
+        self.gamNext[sel] = sub.gam
+        self.F[sel] = sub.F
+
+    def applyForces(self, forces: np.ndarray):
+        self.F[:] = forces
+
+    def update(self, tStep: float, approx: Approximation, relativistic = True):
+        vnew = self.v + tStep * self.a
+        self.aNext[:] = self.F / self.m[:, None]
+        if relativistic:
+            self.gamNext[:] = self.calcGamma(vnew)
+            fast = self.gam > 1.4
+            if np.any(fast):
+                F = self.F[fast]
+                u = vnew[fast]
+                self.aNext[fast] = (F - np.einsum('ij,ij->i', F, u)[:, None] * u) / (
+                        self.m[fast] * self.gamNext[fast])[:, None]
+        if approx == Approximation.EULER:
+            self.rNext[:] = self.r + tStep * self.v
+            self.vNext[:] = vnew
+        elif approx == Approximation.EULER_CROMER:
+            self.vNext[:] = vnew
+            self.rNext[:] = self.r + tStep * self.vNext
+        elif approx == Approximation.VERLET:
+            self.rNext[:] = self.r + tStep * (self.v + 0.5 * tStep * self.a)
+            self.vNext[:] = self.v + 0.5 * tStep * (self.aNext + self.a)
+        else:
+            raise TypeError
+
+    def push(self, E: np.ndarray, B: np.ndarray, tStep: float, approx: Approximation, relativistic = True):
+        self.F[:] = self.q[:, None] * (E + np.cross(self.v, B))
+        if relativistic:
+            gam = self.calcGamma(self.v)
+        else:
+            gam = np.ones(self.N, float)
+        if approx == Approximation.BORIS:
+            rotate = np.zeros(self.N, bool)
+        elif approx == Approximation.EXACT_ROTATION:
+            # The rotation divides by the gyrofrequency, so neutral rows and field-free rows go through Boris
+            rotate = ~np.any(E != 0, axis = 1) & np.any(B != 0, axis = 1) & (self.q * self.m != 0)
+        else:
+            raise TypeError
+        boris = ~rotate
+        if np.any(boris):
+            self.borisPush(boris, E[boris], B[boris], gam[boris], tStep, relativistic)
+        if np.any(rotate):
+            self.rotationPush(rotate, B[rotate], gam[rotate], tStep)
+        self.aNext[:] = (self.vNext - self.v) / tStep
+
+    def borisPush(self, sel: np.ndarray, E: np.ndarray, B: np.ndarray, gam: np.ndarray, tStep: float,
+                  relativistic = True):
+        k = 0.5 * tStep * (self.q[sel] / self.m[sel])[:, None]
+        uMinus = gam[:, None] * self.v[sel] + k * E
+        if relativistic:
+            gMinus = np.sqrt(1 + np.einsum('ij,ij->i', uMinus, uMinus))
+        else:
+            gMinus = np.ones(len(uMinus), float)
+        t = k * B / gMinus[:, None]
+        s = 2 * t / (1 + np.einsum('ij,ij->i', t, t))[:, None]
+        uPrime = uMinus + np.cross(uMinus, t)
+        uPlus = uMinus + np.cross(uPrime, s) + k * E
+        if relativistic:
+            gPlus = np.sqrt(1 + np.einsum('ij,ij->i', uPlus, uPlus))
+        else:
+            gPlus = np.ones(len(uPlus), float)
+        self.vNext[sel] = uPlus / gPlus[:, None]
+        self.rNext[sel] = self.r[sel] + tStep * self.vNext[sel]
+        self.gamNext[sel] = gPlus
+
+    def rotationPush(self, sel: np.ndarray, B: np.ndarray, gam: np.ndarray, tStep: float):
+        bMag = np.linalg.norm(B, axis = 1)
+        b = B / bMag[:, None]
+        omega = self.q[sel] * bMag / (gam * self.m[sel])
+        v = self.v[sel]
+        vPar = np.einsum('ij,ij->i', v, b)[:, None] * b
+        vPerp = v - vPar
+        bxv = np.cross(b, vPerp)
+        phi = (omega * tStep)[:, None]
+        cos = np.cos(phi)
+        sin = np.sin(phi)
+        self.vNext[sel] = vPar + vPerp * cos - bxv * sin
+        self.rNext[sel] = self.r[sel] + vPar * tStep + (vPerp * sin + bxv * (cos - 1)) / omega[:, None]
+        self.gamNext[sel] = gam
+
+    def derivatives(self, r: np.ndarray, u: np.ndarray, fields, relativistic = True, t: float = None):
+        if relativistic:
+            v = u / np.sqrt(1 + np.einsum('ij,ij->i', u, u))[:, None]
+        else:
+            v = u
+        E, B = fields(r) if t is None else fields(r, t)
+        return v, (self.q / self.m)[:, None] * (E + np.cross(v, B))
+
+    def rkStep(self, fields, tStep: float, tolerance: float, relativistic = True, t0: float = None) -> float:
+        if relativistic:
+            u0 = self.calcGamma(self.v)[:, None] * self.v
+        else:
+            u0 = np.copy(self.v)
+        kr = []
+        ku = []
+        for row, node in zip(self.RK45_A, self.RK45_C):
+            r = self.r + tStep * sum(c * k for c, k in zip(row, kr))
+            u = u0 + tStep * sum(c * k for c, k in zip(row, ku))
+            dr, du = self.derivatives(r, u, fields, relativistic, None if t0 is None else t0 + node * tStep)
+            kr.append(dr)
+            ku.append(du)
+        rNew = self.r + tStep * sum(c * k for c, k in zip(self.RK45_B, kr))
+        uNew = u0 + tStep * sum(c * k for c, k in zip(self.RK45_B, ku))
+        rErr = tStep * sum(c * k for c, k in zip(self.RK45_E, kr))
+        uErr = tStep * sum(c * k for c, k in zip(self.RK45_E, ku))
+        rScale = tolerance * (1 + np.maximum(np.abs(self.r), np.abs(rNew)))
+        uScale = tolerance * (1 + np.maximum(np.abs(u0), np.abs(uNew)))
+        err = max(np.max(np.abs(rErr) / rScale, initial = 0), np.max(np.abs(uErr) / uScale, initial = 0))
+        self.rNext[:] = rNew
+        if relativistic:
+            self.gamNext[:] = np.sqrt(1 + np.einsum('ij,ij->i', uNew, uNew))
+        else:
+            self.gamNext[:] = 1
+        self.vNext[:] = uNew / self.gamNext[:, None]
+        self.aNext[:] = ku[-1] / self.gamNext[:, None]
+        self.F[:] = self.m[:, None] * ku[0]
+        return err
+
+    def interpolate(self, r0: np.ndarray, v0: np.ndarray, a0: np.ndarray, tStep: float, theta: float,
+                    relativistic = True):
+        h00 = 2 * theta ** 3 - 3 * theta ** 2 + 1
+        h10 = theta ** 3 - 2 * theta ** 2 + theta
+        h01 = -2 * theta ** 3 + 3 * theta ** 2
+        h11 = theta ** 3 - theta ** 2
+        self.r[:] = h00 * r0 + h10 * tStep * v0 + h01 * self.rNext + h11 * tStep * self.vNext
+        d00 = 6 * theta ** 2 - 6 * theta
+        d10 = 3 * theta ** 2 - 4 * theta + 1
+        d01 = -6 * theta ** 2 + 6 * theta
+        d11 = 3 * theta ** 2 - 2 * theta
+        self.v[:] = (d00 * r0 + d01 * self.rNext) / tStep + d10 * v0 + d11 * self.vNext
+        self.a[:] = (1 - theta) * a0 + theta * self.aNext
+        if relativistic:
+            self.gam[:] = self.calcGamma(self.v)
+        self.invalidate()
+
+    def tick(self):
+        self.a[:] = self.aNext
+        self.v[:] = self.vNext
+        self.r[:] = self.rNext
+        self.gam[:] = self.gamNext
+        self.invalidate()
 
 
 class Particle(TrackableObject, ABC):
     REST_MASS = 0
     CHARGE = 0
     PARTICLETYPE = ''
+    # Defaults for views, which only carry their arrays, index and bunch
+    name = ''
+    ID: int = None
+    bunch: 'Bunch' = None
 
     @classmethod
     def getRestMass(cls):
@@ -21,6 +284,14 @@ class Particle(TrackableObject, ABC):
         # g = 1 / np.sqrt(1 - np.vdot(v, v))
         return 1 / np.sqrt(1 - np.vdot(v, v))
 
+    @classmethod
+    def view(cls, arrays: 'ParticleArrays', index: int, bunch: 'Bunch' = None) -> 'Particle':
+        p = cls.__new__(cls)
+        p.arrays = arrays
+        p.index = index
+        p.bunch = bunch
+        return p
+
     class Property(TrackableProperty):
         ENERGY = 'Energy', False
         MASS = 'Mass', False
@@ -38,6 +309,8 @@ class Particle(TrackableObject, ABC):
                  velocity = np.array([0, 0, 0], float),
                  acceleration = np.array([0, 0, 0], float),
                  mass = float(0), charge = float(0)):
+        self.arrays = ParticleArrays(1)
+        self.index = 0
         self.r = position
         self.v = velocity
         self.a = acceleration
@@ -51,8 +324,123 @@ class Particle(TrackableObject, ABC):
         self.q = charge
         self.name = name
         self.ID: int = None
+        self.bunch: Bunch = None
         self.F = np.array([0, 0, 0], float)
 
+    @property
+    def r(self) -> np.ndarray:
+        return self.arrays.r[self.index]
+
+    @r.setter
+    def r(self, value):
+        self.arrays.r[self.index] = value
+
+    @property
+    def v(self) -> np.ndarray:
+        return self.arrays.v[self.index]
+
+    @v.setter
+    def v(self, value):
+        self.arrays.v[self.index] = value
+
+    @property
+    def a(self) -> np.ndarray:
+        return self.arrays.a[self.index]
+
+    @a.setter
+    def a(self, value):
+        self.arrays.a[self.index] = value
+
+    @property
+    def gam(self) -> float:
+        return self.arrays.gam[self.index]
+
+    @gam.setter
+    def gam(self, value):
+        self.arrays.gam[self.index] = value
+
+    @property
+    def m(self) -> float:
+        return self.arrays.m[self.index]
+
+    @m.setter
+    def m(self, value):
+        self.arrays.m[self.index] = value
+
+    @property
+    def q(self) -> float:
+        return self.arrays.q[self.index]
+
+    @q.setter
+    def q(self, value):
+        self.arrays.q[self.index] = value
+
+    @property
+    def F(self) -> np.ndarray:
+        return self.arrays.F[self.index]
+
+    @F.setter
+    def F(self, value):
+        self.arrays.F[self.index] = value
+
+    @property
+    def mNext(self) -> float:
+        return self.m
+
+    @mNext.setter
+    def mNext(self, value):
+        self.m = value
+
+    @property
+    def rNext(self) -> np.ndarray:
+        return self.arrays.rNext[self.index]
+
+    @rNext.setter
+    def rNext(self, value):
+        self.arrays.rNext[self.index] = value
+
+    @property
+    def vNext(self) -> np.ndarray:
+        return self.arrays.vNext[self.index]
+
+    @vNext.setter
+    def vNext(self, value):
+        self.arrays.vNext[self.index] = value
+
+    @property
+    def aNext(self) -> np.ndarray:
+        return self.arrays.aNext[self.index]
+
+    @aNext.setter
+    def aNext(self, value):
+        self.arrays.aNext[self.index] = value
+
+    @property
+    def gamNext(self) -> float:
+        return self.arrays.gamNext[self.index]
+
+    @gamNext.setter
+    def gamNext(self, value):
+        self.arrays.gamNext[self.index] = value
+
+    def bind(self, arrays: 'ParticleArrays', index: int):
+        for k in ParticleArrays.STATE:
+            getattr(arrays, k)[index] = getattr(self.arrays, k)[self.index]
+        self.arrays = arrays
+        self.index = index
+        if self.bunch is not None:
+            self.bunch.view = None
+            self.bunch.invalidate()
+
+    def getState(self) -> dict:
+        return {k: np.copy(getattr(self, k)) for k in ParticleArrays.STATE}
+
+    def setState(self, state: dict):
+        for k in ParticleArrays.STATE:
+            setattr(self, k, state[k].copy())
+        if self.bunch is not None:
+            self.bunch.invalidate()
+
     def __lt__(self, other):
         if isinstance(other, Particle):
             return self.name < other.name
@@ -81,33 +469,17 @@ class Particle(TrackableObject, ABC):
         # print("Force applied! ", force)
         self.F = force
 
+    def getRow(self) -> ParticleArrays:
+        # One-row view into the shared arrays, so single particles step through the batched code
+        return self.arrays.shard(self.index, self.index + 1)
+
     def update(self, tStep: float, approx: Approximation, relativistic = True):
-        vnew = self.v + tStep * self.a
-        if relativistic:
-            self.gamNext = self.calcGamma(vnew)
-            if self.gam > 1.4:
-                self.aNext = (self.F - np.vdot(self.F, vnew) * vnew) / (self.m * self.gamNext)
-            else:
-                self.aNext = self.F / self.m
-        else:
-            self.aNext = self.F / self.m
-        if approx == Approximation.EULER:
-            self.rNext += tStep * self.v
-            self.vNext += vnew
-        elif approx == Approximation.EULER_CROMER:
-            self.vNext += vnew
-            self.rNext += tStep * self.vNext
-        elif approx == Approximation.VERLET:
-            self.rNext += tStep * (self.v + 0.5 * tStep * self.a)
-            self.vNext += 0.5 * tStep * (self.aNext + self.a)
-        else:
-            raise TypeError
+        self.getRow().update(tStep = tStep, approx = approx, relativistic = relativistic)
 
     def tick(self):
-        self.a = self.aNext
-        self.v = self.vNext
-        self.r = self.rNext
-        self.gam = self.gamNext
+        self.getRow().tick()
+        if self.bunch is not None:
+            self.bunch.invalidate()
 
     def getMomentum(self):
         return self.gam * self.m * self.v
@@ -178,82 +550,160 @@ class Bunch(TrackableObject):
         AVGENERGY = 'Average Energy', False
         AVGMOMENTUM = 'Average Momentum', True
         AVGANGMOMENTUM = 'Average Angular Momentum', True
+        RMSSIZE = 'RMS Size', True
+        EMITTANCE = 'Normalised RMS Emittance', True
+        CORRELATION = 'Position-Momentum Correlation', True
+        ENERGYSPREAD = 'RMS Energy Spread', False
+        ENERGYPERCENTILES = 'Energy Percentiles', False
+
+    PERCENTILES = (10, 50, 90)
 
     def __init__(self, partType: Type[Particle], N: int,
                  position = np.array([0, 0, 0], float),
                  velocity = np.array([0, 0, 0], float),
                  acceleration = np.array([0, 0, 0], float),
-                 R = float(0)):
+                 R = float(0), distribution: Distribution = None):
         self.N = N
         self.partType = partType
-        part = partType(position = position, velocity = velocity, acceleration = acceleration)
-        self.particles: List[Particle] = [part]
+        self.distribution = distribution
         self.ID = None
-        for i in range(N - 1):
-            self.particles.append(deepcopy(part))
+        arrays = ParticleArrays(N)
+        arrays.r[:] = position
+        arrays.v[:] = velocity
+        arrays.a[:] = acceleration
+        arrays.m[:] = partType.getRestMass()
+        arrays.q[:] = partType.getCharge()
+        if distribution is not None:
+            sample = distribution.sample(0, N)
+            m = partType.getRestMass()
+            p = Particle.calcGamma(np.asarray(velocity, float)) * m * np.asarray(velocity, float) + sample[:, 3:]
+            arrays.r += sample[:, :3]
+            arrays.gam[:] = np.sqrt(1 + np.einsum('ij,ij->i', p, p) / m ** 2)
+            arrays.v[:] = p / (m * arrays.gam)[:, None]
+        arrays.rNext[:] = arrays.r
+        arrays.vNext[:] = arrays.v
+        arrays.aNext[:] = arrays.a
+        arrays.gamNext[:] = arrays.gam
+        arrays.bunches = [self]
+        self.particles: List[Particle] = [partType.view(arrays, i, self) for i in range(N)]
+        self.view = None
+        self.cache: dict = None
+        self.stats: dict = None
 
     def getTypeName(self):
-        return self.particles[0].getTypeName()
+        return self.partType.PARTICLETYPE
 
     def getType(self):
-        return type(self.particles[0])
+        return self.partType
+
+    def invalidate(self):
+        self.cache = None
+        self.stats = None
+
+    def getArrays(self):
+        if not self.particles:
+            return (np.zeros((0, 3), float), np.zeros((0, 3), float), np.zeros((0, 3), float), np.zeros(0, float),
+                    np.zeros(0, float), np.zeros(0, float))
+        if self.view is None:
+            arrays = self.particles[0].arrays
+            start = self.particles[0].index
+            if all(p.arrays is arrays and p.index == start + i for i, p in enumerate(self.particles)):
+                self.view = (arrays, slice(start, start + len(self.particles)))
+            elif all(p.arrays is arrays for p in self.particles):
+                self.view = (arrays, np.array([p.index for p in self.particles], int))
+            else:
+                self.view = (None, None)
+        arrays, sel = self.view
+        if arrays is None:
+            return (np.array([p.r for p in self.particles]), np.array([p.v for p in self.particles]),
+                    np.array([p.a for p in self.particles]), np.array([p.gam for p in self.particles]),
+                    np.array([p.m for p in self.particles]), np.array([p.q for p in self.particles]))
+        return arrays.r[sel], arrays.v[sel], arrays.a[sel], arrays.gam[sel], arrays.m[sel], arrays.q[sel]
+
+    def getAggregates(self) -> dict:
+        if self.cache is None:
+            r, v, a, gam, m, q = self.getArrays()
+            p = (gam * m)[:, None] * v
+            self.cache = {'r': r.sum(axis = 0), 'v': v.sum(axis = 0), 'a': a.sum(axis = 0), 'gam': gam.sum(),
+                          'm': m.sum(), 'p': p.sum(axis = 0), 'L': np.cross(r, p).sum(axis = 0),
+                          'E': np.sqrt(np.einsum('ij,ij->i', p, p) + m ** 2).sum()}
+        return self.cache
+
+    def getStatistics(self) -> dict:
+        if self.stats is None:
+            r, v, a, gam, m, q = self.getArrays()
+            if len(m) == 0:
+                nan = np.full(3, np.nan)
+                self.stats = {'size': nan, 'emittance': nan, 'correlation': nan, 'spread': np.nan,
+                              'percentiles': np.full(len(self.PERCENTILES), np.nan)}
+                return self.stats
+            p = (gam * m)[:, None] * v
+            E = np.sqrt(np.einsum('ij,ij->i', p, p) + m ** 2)
+            dr = r - r.mean(axis = 0)
+            dp = p - p.mean(axis = 0)
+            xx = np.einsum('ij,ij->j', dr, dr) / len(m)
+            pp = np.einsum('ij,ij->j', dp, dp) / len(m)
+            xp = np.einsum('ij,ij->j', dr, dp) / len(m)
+            norm = np.sqrt(xx * pp)
+            self.stats = {'size': np.sqrt(xx),
+                          'emittance': np.sqrt(np.maximum(xx * pp - xp ** 2, 0)) / m.mean(),
+                          'correlation': np.divide(xp, norm, out = np.zeros(3), where = norm > 0),
+                          'spread': E.std(), 'percentiles': np.percentile(E, self.PERCENTILES)}
+        return self.stats
+
+    def getRMSSize(self):
+        return np.copy(self.getStatistics()['size'])
+
+    def getEmittance(self):
+        return np.copy(self.getStatistics()['emittance'])
+
+    def getCorrelation(self):
+        return np.copy(self.getStatistics()['correlation'])
+
+    def getEnergySpread(self):
+        return self.getStatistics()['spread']
+
+    def getEnergyPercentiles(self):
+        return np.copy(self.getStatistics()['percentiles'])
 
     def getMomentum(self):
-        mv = np.array([0, 0, 0], float)
-        for i in self.particles:
-            mv += i.getMomentum()
-        return mv
+        return np.copy(self.getAggregates()['p'])
+
+    def getMean(self, total):
+        # A bunch emptied by sinks has no mean, so every average reads NaN instead of dividing by zero
+        if self.N == 0:
+            return total * np.nan
+        return total / self.N
 
     def getAvgMomentum(self):
-        return self.getMomentum() / self.N
+        return self.getMean(self.getMomentum())
 
     def getAngMomentum(self):
-        tau = np.array([0, 0, 0], float)
-        for i in self.particles:
-            tau += i.getAngMomentum()
-        return tau
+        return np.copy(self.getAggregates()['L'])
 
     def getAvgAngMomentum(self):
-        return self.getAngMomentum() / self.N
+        return self.getMean(self.getAngMomentum())
 
     def getPosition(self):
-        r = np.array([0, 0, 0], float)
-        for i in self.particles:
-            r += i.r
-        return r / self.N
+        return self.getMean(self.getAggregates()['r'])
 
     def getVelocity(self):
-        v = np.array([0, 0, 0], float)
-        for i in self.particles:
-            v += i.v
-        return v / self.N
+        return self.getMean(self.getAggregates()['v'])
 
     def getGamma(self):
-        g = float(0)
-        for i in self.particles:
-            g += i.gam
-        return g / self.N
+        return self.getMean(self.getAggregates()['gam'])
 
     def getAcceleration(self):
-        a = np.array([0, 0, 0], float)
-        for i in self.particles:
-            a += i.a
-        return a / self.N
+        return self.getMean(self.getAggregates()['a'])
 
     def getEnergy(self):
-        e = 0
-        for i in self.particles:
-            e += i.getEnergy()
-        return e
+        return self.getAggregates()['E']
 
     def getMass(self):
-        m = 0
-        for i in self.particles:
-            m += i.m
-        return m
+        return self.getAggregates()['m']
 
     def getAvgEnergy(self):
-        return self.getEnergy() / self.N
+        return self.getMean(self.getEnergy())
 
     def __str__(self):
         return self.getFullName() + ' centred at r = ' + str(self.getPosition()) + ' with mv = ' + str(
@@ -285,5 +735,20 @@ class Bunch(TrackableObject):
             return self.getAngMomentum()
         if p is Bunch.Property.AVGANGMOMENTUM:
             return self.getAvgAngMomentum()
+        if p is Bunch.Property.RMSSIZE:
+            return self.getRMSSize()
+        if p is Bunch.Property.EMITTANCE:
+            return self.getEmittance()
+        if p is Bunch.Property.CORRELATION:
+            return self.getCorrelation()
+        if p is Bunch.Property.ENERGYSPREAD:
+            return self.getEnergySpread()
+        if p is Bunch.Property.ENERGYPERCENTILES:
+            return self.getEnergyPercentiles()
         else:
             return None
+
+    def getPropertyLabels(self, p: Property):
+        if p is Bunch.Property.ENERGYPERCENTILES:
+            return ['p' + str(k) for k in self.PERCENTILES]
+        return None
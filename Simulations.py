@@ -1,6 +1,12 @@
+import multiprocessing
+from threading import BrokenBarrierError
+
 from Common import *
 from Fields import *
 from Particles import *
+from Distributions import *
+from Sinks import *
+from Diagnostics import *
 
 class Simulation(Trackable, ABC):
     class Property(TrackableProperty):
@@ -10,52 +16,220 @@ class Simulation(Trackable, ABC):
         ANGMOMENTUM = 'Total Angular Momentum', False
 
     def __init__(self, approx: Approximation, name: str,
-                 tStep: float, timeLength: float, logStep: float = None, relativistic = True):
+                 tStep: float, timeLength: float, logStep: float = None, relativistic = True,
+                 engine: Engine = Engine.OBJECT, tolerance: float = 1e-6, maxStep: float = None,
+                 subSteps: int = 1, logChunk: int = None, workers: int = 1, checkpointStep: float = None,
+                 checkpointPath: str = None, compactInterval: int = 1, indexThreshold: int = 8):
         log('Created new sim: ' + name)
         log.indent()
-        log('Approximation ' + approx.value + ', timestep ' + str(tStep) + ', duration ' + str(timeLength))
+        log('Approximation ' + approx.value + ', timestep ' + str(tStep) + ', duration ' + str(timeLength) +
+            ', ' + engine.value + ' engine')
         self.approx = approx
+        if approx.isElectromagnetic() and engine is not Engine.ARRAY:
+            log(approx.value + ' approximation requires the array engine, switching to it.')
+            engine = Engine.ARRAY
+        if subSteps > 1 and engine is not Engine.ARRAY:
+            log('Sub-cycling requires the array engine, switching to it.')
+            engine = Engine.ARRAY
+        if workers > 1 and approx.isAdaptive():
+            raise TypeError('Sharded runs need a fixed-step approximation')
+        if workers > 1 and engine is not Engine.ARRAY:
+            log('Sharding requires the array engine, switching to it.')
+            engine = Engine.ARRAY
+        self.engine = engine
         self.isRelativisitic = relativistic
         self.name = name
-        self.simlog = SimLog(self.__class__.__name__)
+        if logChunk is None:
+            self.simlog = SimLog(self.__class__.__name__)
+        else:
+            self.simlog = StreamingSimLog(self.__class__.__name__, chunkSize = logChunk)
         self.timeLength = timeLength
         self.tickLength = int(timeLength / tStep) + 1
         self.tStep = tStep
         if logStep is None:
             log('No logstep set. Defaulting to timestep.')
             self.tickLog = 1
+            self.logStep = tStep
         else:
             self.tickLog = int(logStep / tStep)
-        self.tickPrint = int(self.tickLength / 20)
+            self.logStep = logStep
+        if checkpointStep is None:
+            self.tickCheckpoint = 0
+        else:
+            self.tickCheckpoint = max(int(checkpointStep / tStep), 1)
+        self.checkpointStep = checkpointStep
+        if checkpointPath is None:
+            self.checkpointPath = self.simlog.name + '_' + START_TIME_STR + '.ckpt.npz'
+        else:
+            self.checkpointPath = checkpointPath
+        self.resumePath: str = None
+        self.tolerance = tolerance
+        self.maxStep = maxStep
+        self.adaptiveStep = tStep
+        self.nLog = 0
+        self.nCheckpoint = 1
+        self.subSteps = subSteps
+        self.workers = workers
+        self.pool: List[tuple] = []
+        self.barrier = None
+        self.time = float(0)
+        self.tickPrint = max(int(self.tickLength / 20), 1)
         self.currentTick = 0
         self.particles: List[Particle] = []
         self.fields: List[Field] = []
+        self.staticGroups: List[StaticFieldGroup] = []
+        self.activeFields: List[Field] = []
+        self.indexThreshold = indexThreshold
+        self.regionIndex: RegionIndex = None
         self.bunches: List[Bunch] = []
+        self.sinks: List[Sink] = []
+        self.diagnostics: List[Diagnostic] = []
+        self.ids: np.ndarray = None
+        self.arrays: ParticleArrays = None
+        self.alive: np.ndarray = None
+        self.pendingDead: List[int] = []
+        self.compactInterval = compactInterval
+        self.lastCompact = 0
         log.unindent()
         self.running = False
 
-    def start(self):
+    def start(self, save = True):
         self.running = True
-        self.simlog.start()
-        for i in range(self.tickLength):
-            self.tick()
+        self.compileFields()
+        if (self.sinks or self.diagnostics) and self.engine is not Engine.ARRAY:
+            log('Sinks and diagnostics require the array engine, switching to it.')
+            self.engine = Engine.ARRAY
+        if self.engine is Engine.ARRAY:
+            self.arrays = ParticleArrays.fromParticles(self.particles, shared = self.workers > 1)
+            self.alive = np.ones(self.arrays.N, bool)
+            self.ids = np.array([p.ID for p in self.particles], int)
+        if self.resumePath is None:
+            for l in self.getLogs():
+                l.start()
+        else:
+            self.restore(self.resumePath)
+        if self.approx.isAdaptive():
+            self.runAdaptive()
+        elif self.workers > 1:
+            self.startWorkers()
+            try:
+                while self.currentTick < self.tickLength and self.particles:
+                    self.tickSharded()
+                    self.applySinks()
+                    self.checkpointDue()
+            finally:
+                self.stopWorkers()
+        else:
+            while self.currentTick < self.tickLength and self.particles:
+                self.tick()
+                self.applySinks()
+                self.checkpointDue()
         self.running = False
         log('Done in ' + str((datetime.now() - START_TIME).total_seconds()) + 's')
         self.simlog.appendMiscData({'Timestep': self.tStep, 'Duration': self.timeLength,
-                                    'Approximation': self.approx.value})
+                                    'Approximation': self.approx.value, 'Engine': self.engine.value})
+        if self.diagnostics:
+            self.simlog.appendMiscData({'Events': {d.name: d.count for d in self.diagnostics}})
+        if self.sinks:
+            self.simlog.appendMiscData({'Surviving': int(np.count_nonzero(self.alive)),
+                                        'Sinks': {s.name: s.count for s in self.sinks}})
+        if self.approx.isAdaptive():
+            self.simlog.appendMiscData({'Tolerance': self.tolerance, 'Steps': self.currentTick})
         p = SimLog.summariseTrackables(self.particles)
         f = SimLog.summariseTrackables(self.fields)
         b = {}
         for i in self.bunches:
             b.update({'Bunch ' + str(i.ID): str(i.N) + ' ' + i.getTypeName() + 's'})
         self.simlog.appendEnvData({'Particles': p, 'Fields': f, 'Bunches': b})
-        self.simlog.save()
+        if save:
+            self.simlog.save()
         self.post()
 
+    def resume(self, path: str, save = True):
+        self.resumePath = path
+        self.start(save = save)
+
     @abstractmethod
     def post(self):
         pass
 
+    def getLogs(self) -> List[SimLog]:
+        return [self.simlog]
+
+    def getCheckpointFields(self) -> List[Field]:
+        return self.fields
+
+    @classmethod
+    def pack(cls, obj) -> np.ndarray:
+        return np.frombuffer(pickle.dumps(obj), np.uint8)
+
+    @classmethod
+    def unpack(cls, data: np.ndarray):
+        return pickle.loads(data.tobytes())
+
+    def checkpointDue(self):
+        if self.tickCheckpoint and self.currentTick % self.tickCheckpoint == 0 and self.currentTick < self.tickLength:
+            self.checkpoint()
+
+    def checkpoint(self, path: str = None):
+        if path is None:
+            path = self.checkpointPath
+        if self.arrays is None:
+            states = [p.getState() for p in self.particles]
+            particles = {k: np.array([s[k] for s in states]) for k in ParticleArrays.STATE}
+        else:
+            particles = self.arrays.getState()
+        data = {('particle.' + k): v for k, v in particles.items()}
+        data.update({'currentTick': self.currentTick, 'time': self.time, 'adaptiveStep': self.adaptiveStep,
+                     'nLog': self.nLog, 'nCheckpoint': self.nCheckpoint, 'lastCompact': self.lastCompact,
+                     'ids': np.array([p.ID for p in self.particles], int),
+                     'alive': np.ones(len(self.particles), bool) if self.alive is None else self.alive,
+                     'fields': self.pack([f.getState() for f in self.getCheckpointFields()]),
+                     'sinks': self.pack([s.getState() for s in self.sinks]),
+                     'diagnostics': self.pack([d.getState() for d in self.diagnostics]),
+                     'logs': self.pack([l.getState() for l in self.getLogs()])})
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **data)
+        os.replace(tmp, path)
+        log('Checkpointed tick ' + str(self.currentTick) + ' to ' + path)
+
+    def restore(self, path: str):
+        with np.load(path) as data:
+            particles = {k: data['particle.' + k] for k in ParticleArrays.STATE}
+            keep = np.isin([p.ID for p in self.particles], data['ids'])
+            if self.arrays is not None and not np.all(keep):
+                self.compact(keep)
+            if len(particles['r']) != len(self.particles):
+                raise TypeError('Checkpoint holds ' + str(len(particles['r'])) + ' particles, simulation has ' +
+                                str(len(self.particles)))
+            if self.arrays is None:
+                for i, p in enumerate(self.particles):
+                    p.setState({k: v[i] for k, v in particles.items()})
+            else:
+                self.arrays.setState(particles)
+                self.alive = np.copy(data['alive'])
+                self.dropDead(np.flatnonzero(~self.alive))
+            self.currentTick = int(data['currentTick'])
+            self.time = float(data['time'])
+            self.adaptiveStep = float(data['adaptiveStep'])
+            self.nLog = int(data['nLog'])
+            self.nCheckpoint = int(data['nCheckpoint'])
+            self.lastCompact = int(data['lastCompact'])
+            fields = self.unpack(data['fields'])
+            sinks = self.unpack(data['sinks'])
+            diagnostics = self.unpack(data['diagnostics'])
+            logs = self.unpack(data['logs'])
+        for f, state in zip(self.getCheckpointFields(), fields):
+            f.setState(state)
+        for s, state in zip(self.sinks, sinks):
+            s.setState(state)
+        for d, state in zip(self.diagnostics, diagnostics):
+            d.setState(state)
+        for l, state in zip(self.getLogs(), logs):
+            l.setState(state)
+        log('Resumed from ' + path + ' at tick ' + str(self.currentTick))
+
     def addParticle(self, p: Particle, quiet = False):
         j = len(self.particles)
         p.ID = j
@@ -84,37 +258,346 @@ class Simulation(Trackable, ABC):
         f.ID = j
         self.fields.append(f)
         log('Added ' + str(f) + ' with ID ' + str(j), ProgramLog.MsgType.ENV)
+        self.compileFields(quiet = True)
         return j
 
+    def compileFields(self, quiet = False):
+        # Constant uniform fields sharing a region collapse into one E/B pair, leaving only the rest per tick
+        groups = {}
+        self.activeFields = []
+        for f in self.fields:
+            if StaticFieldGroup.isStatic(f):
+                groups.setdefault(id(f.region), StaticFieldGroup(f.region)).add(f)
+            else:
+                self.activeFields.append(f)
+        self.staticGroups = list(groups.values())
+        if not quiet and self.staticGroups:
+            log('Merged ' + str(len(self.fields) - len(self.activeFields)) + ' static fields into ' +
+                str(len(self.staticGroups)) + ' region groups, ' + str(len(self.activeFields)) +
+                ' fields left per tick')
+        # Past a handful of regions, bin them on a grid so each particle only sees the fields it can be inside
+        items = self.getIndexedFields()
+        if self.indexThreshold is not None and len(items) >= self.indexThreshold:
+            self.regionIndex = RegionIndex([getattr(f, 'region', ALL_SPACE) for f in items])
+            if not quiet:
+                log('Indexed ' + str(len(items)) + ' field regions on a ' + 'x'.join(map(str, self.regionIndex.shape)) +
+                    ' grid')
+        else:
+            self.regionIndex = None
+
+    def getIndexedFields(self) -> list:
+        return self.staticGroups + self.activeFields
+
+    def addSink(self, s: Sink):
+        j = len(self.sinks)
+        s.ID = j
+        self.sinks.append(s)
+        log('Added ' + str(s) + ' with ID ' + str(j), ProgramLog.MsgType.ENV)
+        return j
+
+    def addDiagnostic(self, d: Diagnostic):
+        j = len(self.diagnostics)
+        d.ID = j
+        self.diagnostics.append(d)
+        log('Added ' + d.getTypeName() + ' diagnostic ' + str(d) + ' with ID ' + str(j), ProgramLog.MsgType.ENV)
+        return j
+
+    def diagnose(self, r0: np.ndarray, r1: np.ndarray, t0: float, tStep: float):
+        ids = self.ids
+        if not np.all(self.alive):
+            r0, r1, ids = r0[self.alive], r1[self.alive], ids[self.alive]
+        for d in self.diagnostics:
+            record = d.detect(r0, r1, t0, tStep, ids)
+            if record is not None:
+                self.simlog.appendTable(d.name, record)
+
+    def applySinks(self):
+        if not self.sinks:
+            return
+        alive = self.alive
+        for s in self.sinks:
+            hit = alive & s.getHits(self.arrays.r)
+            if np.any(hit):
+                ids = np.array([self.particles[i].ID for i in np.flatnonzero(hit)], int)
+                self.simlog.appendTable(s.name, s.getRecord(ids, self.getCurrentTime(), self.arrays, hit))
+                s.count += len(ids)
+                alive = alive & ~hit
+        dead = np.flatnonzero(self.alive & ~alive)
+        self.alive = alive
+        if len(dead):
+            # Bunches and the fields sourced from them lose the particles now; only the array compaction waits
+            self.dropDead(dead)
+            self.pendingDead.extend(dead.tolist())
+        if not np.all(alive) and (self.currentTick - self.lastCompact >= self.compactInterval or not np.any(alive)):
+            self.compact(alive)
+
+    def dropDead(self, rows: np.ndarray):
+        dead = {id(self.particles[i]) for i in rows}
+        for b in self.bunches:
+            if any(id(p) in dead for p in b.particles):
+                b.particles = [p for p in b.particles if id(p) not in dead]
+                b.N = len(b.particles)
+                b.view = None
+                b.invalidate()
+
+    def compact(self, keep: np.ndarray):
+        restart = bool(self.pool)
+        if restart:
+            self.stopWorkers()
+        self.dropDead(np.flatnonzero(~keep))
+        self.pendingDead = []
+        self.particles = [p for p, k in zip(self.particles, keep) if k]
+        self.arrays = ParticleArrays.fromParticles(self.particles, shared = self.workers > 1)
+        self.alive = np.ones(self.arrays.N, bool)
+        self.ids = np.array([p.ID for p in self.particles], int)
+        self.lastCompact = self.currentTick
+        log('Compacted to ' + str(self.arrays.N) + ' live particles at tick ' + str(self.currentTick))
+        if not self.particles:
+            log('No particles left, stopping at tick ' + str(self.currentTick))
+        elif restart:
+            self.startWorkers()
+
     def getCurrentTime(self):
+        if self.approx.isAdaptive():
+            return self.time
         return self.currentTick * self.tStep
 
     def getForce(self, part: Particle):
         totalF = np.array([0, 0, 0], float)
+        if self.regionIndex is not None:
+            items = self.getIndexedFields()
+            for j in self.regionIndex.getCandidates(part.r):
+                totalF += items[j].getForce(part)
+            return totalF
+        for g in self.staticGroups:
+            totalF += g.getForce(part)
         #        ex = part.getFields()
-        for f in self.fields:
+        for f in self.activeFields:
             #          if f not in ex:
             totalF += f.getForce(part)
         return totalF
 
+    def getForces(self, positions: np.ndarray, velocities: np.ndarray, charges: np.ndarray):
+        totalF = np.zeros((len(positions), 3), float)
+        items = self.getIndexedFields()
+        for j, idx in self.getCandidates(positions):
+            if isinstance(items[j], StaticFieldGroup):
+                items[j].addForces(positions, velocities, charges, totalF, idx)
+            elif idx is None:
+                totalF += items[j].getForces(positions, velocities, charges)
+            else:
+                totalF[idx] += items[j].getForces(positions[idx], velocities[idx], charges[idx])
+        return totalF
+
+    def getCandidates(self, positions: np.ndarray) -> List[tuple]:
+        if self.regionIndex is None:
+            return [(j, None) for j in range(len(self.staticGroups) + len(self.activeFields))]
+        return self.regionIndex.query(positions)
+
+    def setFieldTime(self, time: float):
+        for f in self.activeFields:
+            f.setTime(time)
+
+    def getFieldVectors(self, positions: np.ndarray, time: float = None):
+        if time is not None:
+            self.setFieldTime(time)
+        E = np.zeros((len(positions), 3), float)
+        B = np.zeros((len(positions), 3), float)
+        items = self.getIndexedFields()
+        for j, idx in self.getCandidates(positions):
+            f = items[j]
+            if isinstance(f, StaticFieldGroup):
+                f.addVectors(positions, E, B, idx)
+            elif isinstance(f, (BField, EField)):
+                V = B if isinstance(f, BField) else E
+                if idx is None:
+                    V += f.getVectors(positions)
+                else:
+                    V[idx] += f.getVectors(positions[idx])
+        return E, B
+
     def tick(self):
         prnt = (self.currentTick % self.tickPrint == 0)
         lg = (self.currentTick % self.tickLog == 0)
         if prnt:
             t = self.getCurrentTime()
             print(str(np.round(100 * self.currentTick / self.tickLength)) + '% done')
-        for p in self.particles:
-            p.applyForce(self.getForce(p))
-            p.update(tStep = self.tStep, approx = self.approx, relativistic = self.isRelativisitic)
+        self.setFieldTime(self.getCurrentTime())
+        if self.arrays is None:
+            for p in self.particles:
+                p.applyForce(self.getForce(p))
+                p.update(tStep = self.tStep, approx = self.approx, relativistic = self.isRelativisitic)
+        elif self.subSteps > 1:
+            self.subCycle(self.arrays)
+        else:
+            self.step(self.arrays, self.tStep)
         if lg:
-            self.simlog()
-        for p in self.particles:
-            p.tick()
-        for f in self.fields:
+            self.logState()
+        if self.arrays is None:
+            for p in self.particles:
+                p.tick()
+        else:
+            if self.diagnostics:
+                self.diagnose(self.arrays.r, self.arrays.rNext, self.getCurrentTime(), self.tStep)
+            self.arrays.tick()
+        self.tickFields()
+        self.currentTick += 1
+
+    def logState(self):
+        self.simlog()
+
+    def tickFields(self, tStep: float = None):
+        for f in self.activeFields:
             f.update()
-            f.tick()
+            f.tick(tStep)
+
+    def step(self, arrays: ParticleArrays, tStep: float):
+        if self.approx.isElectromagnetic():
+            E, B = self.getFieldVectors(arrays.r)
+            arrays.push(E, B, tStep = tStep, approx = self.approx, relativistic = self.isRelativisitic)
+        else:
+            arrays.applyForces(self.getForces(arrays.r, arrays.v, arrays.q))
+            arrays.update(tStep = tStep, approx = self.approx, relativistic = self.isRelativisitic)
+
+    def getSubCycleMask(self, positions: np.ndarray) -> np.ndarray:
+        mask = np.zeros(len(positions), bool)
+        for f in self.fields:
+            if f.TIMEVARYING:
+                mask |= f.region.containsMany(positions)
+        return mask
+
+    def subCycle(self, arrays: ParticleArrays):
+        mask = self.getSubCycleMask(arrays.r)
+        if not np.any(mask):
+            self.step(arrays, self.tStep)
+            return
+        # Only the particles outside every time-varying region take the full step
+        if not np.all(mask):
+            rest = arrays.take(~mask)
+            self.step(rest, self.tStep)
+            arrays.putNext(~mask, rest)
+        sub = arrays.take(mask)
+        t0 = self.getCurrentTime()
+        for i in range(self.subSteps):
+            self.setFieldTime(t0 + i * self.tStep / self.subSteps)
+            self.step(sub, self.tStep / self.subSteps)
+            sub.tick()
+        self.setFieldTime(t0)
+        arrays.putNext(mask, sub)
+
+    def startWorkers(self):
+        ctx = multiprocessing.get_context('fork')
+        self.barrier = ctx.Barrier(self.workers + 1)
+        bounds = np.linspace(0, self.arrays.N, self.workers + 1).astype(int)
+        for f in self.fields:
+            f.beginSync()
+        log('Sharding ' + str(self.arrays.N) + ' particles across ' + str(self.workers) + ' workers')
+        for k in range(self.workers):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target = self.runShard, args = (child, bounds[k], bounds[k + 1]), daemon = True)
+            proc.start()
+            self.pool.append((proc, parent))
+
+    def stopWorkers(self):
+        for proc, conn in self.pool:
+            conn.send(None)
+        for proc, conn in self.pool:
+            proc.join()
+        self.pool = []
+        self.barrier = None
+        self.arrays.release()
+
+    def runShard(self, conn, start: int, stop: int):
+        shard = self.arrays.shard(start, stop)
+        try:
+            while True:
+                message = conn.recv()
+                if message is None:
+                    break
+                self.currentTick, states, dead = message
+                for f, state in zip(self.fields, states):
+                    f.setSyncState(state)
+                # Fields were rebuilt from the bunches as they stood before the sinks, as in the main process
+                self.dropDead(dead)
+                if self.subSteps > 1:
+                    self.subCycle(shard)
+                else:
+                    self.step(shard, self.tStep)
+                # No shard may overwrite positions while another is still rebuilding its fields from them
+                self.barrier.wait()
+                shard.tick()
+                self.barrier.wait()
+        except BrokenBarrierError:
+            pass
+        except BaseException:
+            self.barrier.abort()
+            raise
+
+    def tickSharded(self):
+        if self.currentTick % self.tickPrint == 0:
+            print(str(np.round(100 * self.currentTick / self.tickLength)) + '% done')
+        # Logging only reads current state, which the workers leave untouched until shard.tick()
+        if self.currentTick % self.tickLog == 0:
+            self.logState()
+        if self.diagnostics:
+            r0 = np.copy(self.arrays.r)
+        self.setFieldTime(self.getCurrentTime())
+        states = [f.getSyncState() for f in self.fields]
+        for proc, conn in self.pool:
+            conn.send((self.currentTick, states, self.pendingDead))
+        self.pendingDead = []
+        self.barrier.wait()
+        self.barrier.wait()
+        self.arrays.invalidate()
+        if self.diagnostics:
+            self.diagnose(r0, self.arrays.r, self.getCurrentTime(), self.tStep)
+        self.tickFields()
         self.currentTick += 1
 
+    def runAdaptive(self):
+        tStep = self.adaptiveStep
+        nPrint = int(20 * self.time / self.timeLength) + 1
+        while self.time < self.timeLength and self.particles:
+            if self.maxStep is not None:
+                tStep = min(tStep, self.maxStep)
+            last = self.time + tStep >= self.timeLength
+            if last:
+                tStep = self.timeLength - self.time
+            err = self.arrays.rkStep(self.getFieldVectors, tStep, self.tolerance, self.isRelativisitic, self.time)
+            if err > 1:
+                tStep *= max(0.2, 0.9 * err ** -0.2)
+                if tStep < 1e-12 * self.timeLength:
+                    raise ArithmeticError('Adaptive timestep underflow at t = ' + str(self.time))
+                continue
+            t0 = self.time
+            r0 = np.copy(self.arrays.r)
+            v0 = np.copy(self.arrays.v)
+            a0 = np.copy(self.arrays.a)
+            while self.nLog * self.logStep <= t0 + tStep * (1 + 1e-9):
+                self.time = self.nLog * self.logStep
+                self.arrays.interpolate(r0, v0, a0, tStep, (self.time - t0) / tStep, self.isRelativisitic)
+                self.logState()
+                self.nLog += 1
+            if self.diagnostics:
+                self.diagnose(r0, self.arrays.rNext, t0, tStep)
+            self.arrays.tick()
+            if last:
+                self.time = self.timeLength
+            else:
+                self.time = t0 + tStep
+            self.tickFields(tStep)
+            self.currentTick += 1
+            self.applySinks()
+            if self.time >= nPrint * self.timeLength / 20:
+                print(str(np.round(100 * self.time / self.timeLength)) + '% done')
+                nPrint += 1
+            tStep *= min(5.0, 0.9 * err ** -0.2) if err > 0 else 5.0
+            self.adaptiveStep = tStep
+            if (self.checkpointStep is not None and
+                    self.nCheckpoint * self.checkpointStep <= self.time < self.timeLength):
+                self.nCheckpoint = int(self.time / self.checkpointStep) + 1
+                self.checkpoint()
+
     def getTotalEnergy(self):
         e = float(0)
         for p in self.particles:
@@ -153,10 +636,11 @@ class Simulation(Trackable, ABC):
 
 class SingleProtonSimulation(Simulation):
 
-    def __init__(self, approx: Approximation, tStep: float, timeLength: float, logStep: float = None):
+    def __init__(self, approx: Approximation, tStep: float, timeLength: float, logStep: float = None, **kwargs):
         super(SingleProtonSimulation, self).__init__(approx = approx,
                                                      name = 'Single Proton in Constant Uniform B-Field',
-                                                     tStep = tStep, timeLength = timeLength, logStep = logStep)
+                                                     tStep = tStep, timeLength = timeLength, logStep = logStep,
+                                                     **kwargs)
         # self.addField(ConstantUniformBField(fieldVector = np.array([0, 0, 1000], float)))
         pro = Proton(velocity = np.array([1, 0, 0], float))
         self.addParticle(pro)
@@ -171,20 +655,30 @@ class SingleProtonSimulation(Simulation):
 class CyclotronSimulation(Simulation):
 
     def __init__(self, approx: Approximation, tStep: float, timeLength: float, logStep: float = None,
-                 part: Type[Particle] = Proton, nBunch: int = 1, nPerBunch: int = 10):
+                 part: Type[Particle] = Proton, nBunch: int = 1, nPerBunch: int = 10,
+                 bField: float = 1000, eField: float = 100, gapWidth: float = 10,
+                 extractionRadius: float = None, events: bool = False,
+                 distribution: Distribution = None, **kwargs):
         super(CyclotronSimulation, self).__init__(approx = approx, relativistic = True,
                                                   tStep = tStep, timeLength = timeLength,
-                                                  logStep = logStep, name = part.__name__ + ' Cyclotron')
+                                                  logStep = logStep, name = part.__name__ + ' Cyclotron', **kwargs)
         self.simlog.track(self, Simulation.Property.TIME)
-        b = Bunch(partType = part, N = nPerBunch, velocity = np.array([0.1, 0, 0], float))
+        b = Bunch(partType = part, N = nPerBunch, velocity = np.array([0.1, 0, 0], float),
+                  distribution = distribution)
         self.addBunch(b)
         self.simlog.track(b, Bunch.Property.POS, Bunch.Property.VEL, Bunch.Property.GAMMA)
-        bf = ConstantUniformBField(np.array([0, 0, 1000]))
+        bf = ConstantUniformBField(np.array([0, 0, bField], float))
         self.addField(bf)
-        r = AxisRegion(-5, 5, Axis.X)
-        c = CyclotronEField(fieldVector = np.array([100, 0, 0], float), partType = part, bField = bf, tStep = tStep,
+        r = AxisRegion(-gapWidth / 2, gapWidth / 2, Axis.X)
+        c = CyclotronEField(fieldVector = np.array([eField, 0, 0], float), partType = part, bField = bf, tStep = tStep,
                             region = r)
         self.addField(c)
+        if extractionRadius is not None:
+            self.addSink(ExtractionSink(~CylinderRegion(extractionRadius), name = 'Extraction'))
+        if events:
+            self.addDiagnostic(GapCrossingDiagnostic(r, name = 'Gap Crossings'))
+            self.addDiagnostic(TurnDiagnostic(name = 'Turns'))
+            self.addDiagnostic(PolarityDiagnostic(c, name = 'Polarity Flips'))
 
     def post(self):
         pass
@@ -192,20 +686,31 @@ class CyclotronSimulation(Simulation):
 class SynchroCyclotronSimulation(Simulation):
 
     def __init__(self, approx: Approximation, tStep: float, timeLength: float, logStep: float = None,
-                 part: Type[Particle] = Proton, nBunch: int = 1, nPerBunch: int = 10):
+                 part: Type[Particle] = Proton, nBunch: int = 1, nPerBunch: int = 10,
+                 bField: float = 1000, eField: float = 100, gapWidth: float = 10,
+                 extractionRadius: float = None, events: bool = False,
+                 distribution: Distribution = None, **kwargs):
         super(SynchroCyclotronSimulation, self).__init__(approx = approx, relativistic = True,
                                                          tStep = tStep, timeLength = timeLength,
-                                                         logStep = logStep, name = part.__name__ + ' Synchrocyclotron')
+                                                         logStep = logStep, name = part.__name__ + ' Synchrocyclotron',
+                                                         **kwargs)
         self.simlog.track(self, Simulation.Property.TIME)
-        b = Bunch(partType = part, N = nPerBunch, velocity = np.array([0.1, 0, 0], float))
+        b = Bunch(partType = part, N = nPerBunch, velocity = np.array([0.1, 0, 0], float),
+                  distribution = distribution)
         self.addBunch(b)
         self.simlog.track(b, Bunch.Property.POS, Bunch.Property.VEL, Bunch.Property.GAMMA)
-        bf = ConstantUniformBField(np.array([0, 0, 1000]))
+        bf = ConstantUniformBField(np.array([0, 0, bField], float))
         self.addField(bf)
-        r = AxisRegion(-5, 5, Axis.X)
-        c = SynchroCyclotronEField(fieldVector = np.array([100, 0, 0], float), referenceObject = b, bField = bf,
+        r = AxisRegion(-gapWidth / 2, gapWidth / 2, Axis.X)
+        c = SynchroCyclotronEField(fieldVector = np.array([eField, 0, 0], float), referenceObject = b, bField = bf,
                                    tStep = tStep, region = r)
         self.addField(c)
+        if extractionRadius is not None:
+            self.addSink(ExtractionSink(~CylinderRegion(extractionRadius), name = 'Extraction'))
+        if events:
+            self.addDiagnostic(GapCrossingDiagnostic(r, name = 'Gap Crossings'))
+            self.addDiagnostic(TurnDiagnostic(name = 'Turns'))
+            self.addDiagnostic(PolarityDiagnostic(c, name = 'Polarity Flips'))
 
     def post(self):
         pass
@@ -213,21 +718,164 @@ class SynchroCyclotronSimulation(Simulation):
 class IsoCyclotronSimulation(Simulation):
 
     def __init__(self, approx: Approximation, tStep: float, timeLength: float, logStep: float = None,
-                 part: Type[Particle] = Proton, nBunch: int = 1, nPerBunch: int = 10):
+                 part: Type[Particle] = Proton, nBunch: int = 1, nPerBunch: int = 10,
+                 bField: float = 1000, eField: float = 10, gapWidth: float = 10,
+                 extractionRadius: float = None, events: bool = False,
+                 distribution: Distribution = None, radialMap: bool = False, **kwargs):
         super(IsoCyclotronSimulation, self).__init__(approx = approx, relativistic = True,
                                                      tStep = tStep, timeLength = timeLength,
                                                      logStep = logStep,
-                                                     name = part.__name__ + ' Isosynchronous Cyclotron')
+                                                     name = part.__name__ + ' Isosynchronous Cyclotron', **kwargs)
         self.simlog.track(self, Simulation.Property.TIME)
-        b = Bunch(partType = part, N = nPerBunch, velocity = np.array([0.1, 0, 0], float))
+        b = Bunch(partType = part, N = nPerBunch, velocity = np.array([0.1, 0, 0], float),
+                  distribution = distribution)
         self.addBunch(b)
         self.simlog.track(b, Bunch.Property.POS, Bunch.Property.VEL, Bunch.Property.GAMMA)
-        bf = IsoCyclotronBField(fieldVector = np.array([0, 0, 1000]), referenceObject = b)
+        if radialMap:
+            # The isochronous profile diverges where the orbit would reach c, so stop the map just short of it
+            bf = RadialMapBField.isochronous(bField, part, 0.99 * part.getRestMass() / abs(part.getCharge() * bField))
+        else:
+            bf = IsoCyclotronBField(fieldVector = np.array([0, 0, bField], float), referenceObject = b)
         self.addField(bf)
-        r = AxisRegion(-5, 5, Axis.X)
-        c = CyclotronEField(fieldVector = np.array([10, 0, 0], float), partType = part, bField = bf,
+        r = AxisRegion(-gapWidth / 2, gapWidth / 2, Axis.X)
+        c = CyclotronEField(fieldVector = np.array([eField, 0, 0], float), partType = part, bField = bf,
                             tStep = tStep, region = r)
         self.addField(c)
+        if extractionRadius is not None:
+            self.addSink(ExtractionSink(~CylinderRegion(extractionRadius), name = 'Extraction'))
+        if events:
+            self.addDiagnostic(GapCrossingDiagnostic(r, name = 'Gap Crossings'))
+            self.addDiagnostic(TurnDiagnostic(name = 'Turns'))
+            self.addDiagnostic(PolarityDiagnostic(c, name = 'Polarity Flips'))
+
+    def post(self):
+        pass
+
+
+class EnsembleSimulation(Simulation):
+
+    def __init__(self, simType: Type[Simulation], variants: List[dict], approx: Approximation, tStep: float,
+                 timeLength: float, logStep: float = None, tolerance: float = 1e-6, maxStep: float = None,
+                 logChunk: int = None, checkpointStep: float = None, checkpointPath: str = None, **kwargs):
+        super(EnsembleSimulation, self).__init__(approx = approx, name = simType.__name__ + ' Ensemble',
+                                                 tStep = tStep, timeLength = timeLength, logStep = logStep,
+                                                 engine = Engine.ARRAY, tolerance = tolerance, maxStep = maxStep,
+                                                 logChunk = logChunk, checkpointStep = checkpointStep,
+                                                 checkpointPath = checkpointPath)
+        # The ensemble ticks its members itself, so per-member sub-cycling or sharding would be silently dropped
+        for key, default in (('subSteps', 1), ('workers', 1)):
+            if any(dict(kwargs, **v).get(key, default) != default for v in variants):
+                raise TypeError(key + ' is not supported in ensemble runs')
+        if approx.isAdaptive():
+            log('Ensemble members share one adaptive step, so they match separate runs only to within the tolerance')
+        self.variants = variants
+        self.members: List[Simulation] = []
+        self.memberSlices: List[slice] = []
+        log('Building ' + str(len(variants)) + ' ensemble members')
+        for k, v in enumerate(variants):
+            m = simType(approx = approx, tStep = tStep, timeLength = timeLength, logStep = logStep,
+                        logChunk = logChunk, **dict(kwargs, **v))
+            m.simlog.name += '_' + str(k)
+            if isinstance(m.simlog, StreamingSimLog):
+                m.simlog.path += '_' + str(k)
+            m.simlog.appendMiscData({'Variant': {i: str(j) for i, j in v.items()}})
+            start = len(self.particles)
+            self.particles.extend(m.particles)
+            self.memberSlices.append(slice(start, len(self.particles)))
+            self.members.append(m)
+        self.memberIndex = np.concatenate([np.full(s.stop - s.start, k) for k, s in enumerate(self.memberSlices)])
+        self.fieldGroups = list(zip(*[m.fields for m in self.members]))
+        if any(len(m.fields) != len(self.fieldGroups) for m in self.members):
+            raise TypeError('Ensemble members must share the same field layout')
+        if any(m.sinks or m.diagnostics for m in self.members):
+            raise TypeError('Sinks and diagnostics are not supported in ensemble runs')
+        self.simlog.track(self, Simulation.Property.TIME)
+
+    def start(self, save = True):
+        for m in self.members:
+            m.running = True
+        super(EnsembleSimulation, self).start(save = save)
+        for m, v in zip(self.members, self.variants):
+            m.running = False
+            m.simlog.appendMiscData({'Timestep': self.tStep, 'Duration': self.timeLength,
+                                     'Approximation': self.approx.value, 'Engine': 'Ensemble'})
+            if save:
+                m.simlog.save()
+
+    def addSink(self, s: Sink):
+        raise TypeError('Sinks are not supported in ensemble runs')
+
+    def addDiagnostic(self, d: Diagnostic):
+        raise TypeError('Diagnostics are not supported in ensemble runs')
+
+    def getLogs(self) -> List[SimLog]:
+        return [self.simlog] + [m.simlog for m in self.members]
+
+    def getCheckpointFields(self) -> List[Field]:
+        return [f for m in self.members for f in m.fields]
+
+    def restore(self, path: str):
+        super(EnsembleSimulation, self).restore(path)
+        for m in self.members:
+            m.currentTick = self.currentTick
+            m.time = self.time
+
+    def getGroupMask(self, group: tuple, positions: np.ndarray) -> np.ndarray:
+        regions = [f.region for f in group]
+        first = regions[0]
+        if all(r is first for r in regions):
+            return first.containsMany(positions)
+        if all(isinstance(r, AxisRegion) and r.axis is first.axis for r in regions):
+            x = positions[:, first.axis.value]
+            b1 = np.array([r.b1 for r in regions], float)[self.memberIndex]
+            b2 = np.array([r.b2 for r in regions], float)[self.memberIndex]
+            return (x >= b1) & (x <= b2)
+        if all(isinstance(r, CubeRegion) for r in regions):
+            lower = np.array([[r.x1, r.y1, r.z1] for r in regions], float)[self.memberIndex]
+            upper = np.array([[r.x2, r.y2, r.z2] for r in regions], float)[self.memberIndex]
+            return np.all((positions >= lower) & (positions <= upper), axis = 1)
+        return np.concatenate([r.containsMany(positions[s]) for r, s in zip(regions, self.memberSlices)])
+
+    def getGroupVectors(self, group: tuple, positions: np.ndarray) -> np.ndarray:
+        if len(positions) != len(self.memberIndex):
+            raise TypeError('Ensemble fields are evaluated over the whole population only')
+        if all(isinstance(f, UniformField) for f in group):
+            vectors = np.array([f.fieldVector for f in group], float)[self.memberIndex]
+            vectors[~self.getGroupMask(group, positions)] = 0
+            return vectors
+        return np.concatenate([f.getVectors(positions[s]) for f, s in zip(group, self.memberSlices)])
+
+    def getForces(self, positions: np.ndarray, velocities: np.ndarray, charges: np.ndarray):
+        E, B = self.getFieldVectors(positions)
+        return charges[:, None] * (E + np.cross(velocities, B))
+
+    def setFieldTime(self, time: float):
+        for m in self.members:
+            m.setFieldTime(time)
+
+    def getFieldVectors(self, positions: np.ndarray, time: float = None):
+        if time is not None:
+            self.setFieldTime(time)
+        E = np.zeros((len(positions), 3), float)
+        B = np.zeros((len(positions), 3), float)
+        for group in self.fieldGroups:
+            if isinstance(group[0], BField):
+                B += self.getGroupVectors(group, positions)
+            elif isinstance(group[0], EField):
+                E += self.getGroupVectors(group, positions)
+        return E, B
+
+    def logState(self):
+        self.simlog()
+        for m in self.members:
+            m.time = self.time
+            m.simlog()
+
+    def tickFields(self, tStep: float = None):
+        for m in self.members:
+            m.tickFields(tStep)
+            m.currentTick += 1
+            m.time = self.time
 
     def post(self):
         pass
@@ -0,0 +1,60 @@
+from Common import *
+from Particles import ParticleArrays
+
+
+class Sink(ABC):
+
+    SINKTYPE = 'Sink'
+
+    def __init__(self, region: Region, name: str = None):
+        self.region = region
+        self.ID = None
+        self.count = 0
+        if name is None:
+            self.name = self.SINKTYPE
+        else:
+            self.name = name
+
+    def getHits(self, positions: np.ndarray) -> np.ndarray:
+        return self.region.containsMany(positions)
+
+    @abstractmethod
+    def getRecord(self, ids: np.ndarray, time: float, arrays: ParticleArrays, hit: np.ndarray) -> dict:
+        pass
+
+    def getState(self) -> dict:
+        return {'count': self.count}
+
+    def setState(self, state: dict):
+        self.__dict__.update(state)
+
+    def getTypeName(self):
+        return self.SINKTYPE
+
+    def __str__(self):
+        return self.name
+
+
+class AbsorbingSink(Sink):
+
+    SINKTYPE = 'Absorbing Sink'
+
+    def getRecord(self, ids: np.ndarray, time: float, arrays: ParticleArrays, hit: np.ndarray) -> dict:
+        r = arrays.r[hit]
+        return {'ID': ids, 'Time': np.full(len(ids), time, float),
+                'Position - x': r[:, 0], 'Position - y': r[:, 1], 'Position - z': r[:, 2]}
+
+
+class ExtractionSink(Sink):
+
+    SINKTYPE = 'Extraction Sink'
+
+    def getRecord(self, ids: np.ndarray, time: float, arrays: ParticleArrays, hit: np.ndarray) -> dict:
+        r = arrays.r[hit]
+        m = arrays.m[hit]
+        gam = arrays.gam[hit]
+        p = (gam * m)[:, None] * arrays.v[hit]
+        return {'ID': ids, 'Time': np.full(len(ids), time, float),
+                'Position - x': r[:, 0], 'Position - y': r[:, 1], 'Position - z': r[:, 2],
+                'Momentum - x': p[:, 0], 'Momentum - y': p[:, 1], 'Momentum - z': p[:, 2],
+                'Gamma': np.copy(gam), 'Energy': np.sqrt(np.einsum('ij,ij->i', p, p) + m ** 2)}
@@ -0,0 +1,96 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+from Common import *
+from Simulations import *
+
+
+class SweepResults:
+
+    def __init__(self, name: str, points: List[dict]):
+        self.name = name
+        self.points = points
+        self.status: List[str] = ['Pending'] * len(points)
+        self.errors: List[str] = [None] * len(points)
+        self.logs: dict = {}
+
+    def record(self, i: int, simlog: SimLog, error: str):
+        if simlog is None:
+            self.status[i] = 'Failed'
+            self.errors[i] = error
+        else:
+            self.status[i] = 'Done'
+            self.logs.update({i: simlog})
+
+    def getSummary(self) -> DataFrame:
+        rows = []
+        for i, p in enumerate(self.points):
+            row = {k: (v.value if isinstance(v, Enum) else v) for k, v in p.items()}
+            row.update({'Status': self.status[i], 'Error': self.errors[i]})
+            rows.append(row)
+        return DataFrame(rows)
+
+    def getLog(self, i: int) -> SimLog:
+        return self.logs.get(i)
+
+    def getTrackedData(self, i: int) -> DataFrame:
+        return self.logs[i].getTrackedData()
+
+    def __len__(self):
+        return len(self.points)
+
+    def save(self, filename: str = None):
+        if filename is None:
+            file = self.name + '_' + START_TIME_STR + '.pickle'
+        else:
+            file = filename
+        log('Pickling sweep results to ' + file + '... ', endLine = False)
+        with open(file, 'wb') as f:
+            pickle.dump(self, f)
+        print('done')
+
+
+class ParameterSweep:
+
+    @classmethod
+    def runPoint(cls, simType: Type[Simulation], params: dict, i: int, retries: int):
+        error = None
+        for attempt in range(retries + 1):
+            try:
+                sim = simType(**params)
+                if isinstance(sim.simlog, StreamingSimLog):
+                    sim.simlog.path += '_' + str(i)
+                sim.start(save = False)
+                if isinstance(sim.simlog, StreamingSimLog):
+                    sim.simlog.save()
+                return sim.simlog, None
+            except Exception as e:
+                error = type(e).__name__ + ': ' + str(e)
+        return None, error
+
+    def __init__(self, simType: Type[Simulation], grid: dict, fixed: dict = None, processes: int = None,
+                 retries: int = 1):
+        self.simType = simType
+        self.fixed = {} if fixed is None else fixed
+        self.points = [dict(zip(grid, values)) for values in product(*grid.values())]
+        self.processes = processes
+        self.retries = retries
+        log('Created sweep of ' + simType.__name__ + ' over ' + str(len(self.points)) + ' points: ' +
+            ', '.join(k + ' (' + str(len(v)) + ')' for k, v in grid.items()))
+
+    def start(self, save = True) -> SweepResults:
+        results = SweepResults(self.simType.__name__ + 'Sweep', self.points)
+        # Executor workers are not daemonic, so a point may shard itself across workers of its own
+        with ProcessPoolExecutor(self.processes) as pool:
+            pending = [pool.submit(ParameterSweep.runPoint, self.simType, dict(self.fixed, **p), i, self.retries)
+                       for i, p in enumerate(self.points)]
+            for i, r in enumerate(pending):
+                try:
+                    simlog, error = r.result()
+                except Exception as e:
+                    simlog, error = None, type(e).__name__ + ': ' + str(e)
+                results.record(i, simlog, error)
+                log('Sweep point ' + str(i + 1) + '/' + str(len(self.points)) + ' ' + results.status[i].lower())
+        if save:
+            results.save()
+        return results